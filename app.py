@@ -3,24 +3,38 @@ import dash
 from dash import html
 from dash import dcc
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
 import datetime
 import json
-from dash.dependencies import Input, Output, MATCH, ALL, State
+import traceback
+from dash.dependencies import Input, Output, MATCH, ALL, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 
 from viz_app.main import app
-from viz_app.storage import Storage
+from viz_app.data import DAY_LABELS, available_years
+from viz_app.data import frame_cache
+from viz_app.query import aggregate_years, dataset_years, dataset_domains, counts_version, filter_cache
+from viz_app.figures import figure_cache, compressed_cache, figure_key, get_figures, put_figures
+from viz_app.watcher import watcher
+from viz_app.jobs import jobs
 from viz_app.views.map import make_map_panel, make_map_graphs
-from viz_app.views.correlations import make_correlations_panel, make_correlations_graphs
+from viz_app.views.correlations import make_correlations_panel, make_correlations_graphs, correlations_group_by, \
+                                       is_heavy
 from viz_app.views.trends import make_trends_panel, make_trends_graphs
 from config import ID_TO_LIGHT_CONDITIONS, ID_TO_JUNCTION_DETAIL, ID_TO_LOCAL_DISTRICT, ID_TO_REGION, ID_TO_SPECIAL_CONDITIONS_AT_SITE, CATEGORICAL_ATTRIBS, LOCATION_ATTRIBS, POPULATION_BY_REGION, QUANTITATIVE_ATTRIBS, \
                    MISSING_VALUE_TABLE, ID_TO_JUNCTION_CONTROL, ID_TO_ROAD_SURFACE_CONDITIONS, ID_TO_SPECIAL_CONDITIONS_AT_SITE, \
                    LIGHT_CONDITIONS, SPECIAL_CONDITIONS_AT_SITE, ROAD_SURFACE_CONDITIONS, \
-                   JUNCTION_CONTROL, JUNCTION_DETAIL, ALL_ATTRIBUTES, SPEED_LIMIT
+                   JUNCTION_CONTROL, JUNCTION_DETAIL, ALL_ATTRIBUTES, SPEED_LIMIT, ALL_YEARS, WATCH_INTERVAL_SECONDS, \
+                   SEQ_CONT_COL, DISCRETE_COL, JOB_POLL_INTERVAL_MS
 
 
 
-storage = Storage({})
+# The sizes and hit rates of the caches of this server process
+@app.server.route("/stats")
+def cache_stats():
+    return {"data": frame_cache.stats(), "filters": filter_cache.stats(), "figures": figure_cache.stats(),
+            "compressed": compressed_cache.stats()}
 
 # This function joins the module and built-in palette name (discrete), e.g. px.colors.qualitative.Reds
 def get_disc_color(c):
@@ -34,6 +48,18 @@ def get_seq_cont_color(c):
 def generate_dropdown_label(a):
     return a.replace("_", " ").title()
 
+# The palettes that can be chosen and the quantitative attributes, for the clientside callbacks
+def clientside_config():
+    return {
+        "sequential": {c: get_seq_cont_color(c) for c in SEQ_CONT_COL},
+        "qualitative": {c: get_disc_color(c) for c in DISCRETE_COL},
+        "quantitative": QUANTITATIVE_ATTRIBS,
+    }
+
+# The options of the dataset year dropdown, every year that is available and all years together
+def dataset_year_options():
+    return [{"label": "All years", "value": ALL_YEARS}] + [{"label": i, "value": i} for i in available_years()]
+
 app.layout = html.Div(
     style={"width": "100%", "height": "100%"},
     children = [
@@ -80,10 +106,12 @@ app.layout = html.Div(
                 html.Label("Dataset Year"),
                 dcc.Dropdown(
                     id="dataset-year",
-                    options=[{"label": i, "value": i} for i in range(1979, 2021)],
-                    value=2020,
+                    options=dataset_year_options(),
+                    value=max(available_years(), default=None),
                     searchable=False,
                 ),
+                # Checks for years that were added to the dataset directory
+                dcc.Interval(id="dataset-year-poll", interval=WATCH_INTERVAL_SECONDS * 1000),
             ]),
             html.Div(
                 id='panel-content', className="control_card",
@@ -118,30 +146,55 @@ app.layout = html.Div(
                 id="btn-apply-filter",
                 n_clicks = 0
             ),
+            # Number of accidents that match the filters as they are edited, before they are applied
+            html.P(id="filter-preview"),
         ]
     ),
     html.Div(
         id="rightColumn",
         className="eight columns",
         children=[
-            html.Div(id='graph-content'),
+            # The graphs of every view, with the counts they are made from
+            html.Div(id='map-content'),
+            html.Div(id='correlations-content'),
+            html.Div(id='trends-content'),
+            dcc.Store(id='map-counts'),
+            dcc.Store(id='correlations-counts'),
+            dcc.Store(id='trends-counts'),
+            # Background job that makes the correlations graphs, and the interval that checks whether it is done
+            dcc.Store(id='correlations-job'),
+            dcc.Interval(id='correlations-poll', interval=JOB_POLL_INTERVAL_MS, disabled=True),
+            # Set when the graphs of a job were made with other colors or another sorting order than
+            # the current ones, so they are restyled in the browser
+            dcc.Store(id='correlations-restyle'),
+            # The palettes and attribute types used by the clientside callbacks (assets/clientside.js)
+            dcc.Store(id='clientside-config', data=clientside_config()),
         ]
     ),
 ])
 
 
-@ app.callback(Output('home-page', 'style'),
+# Show the home page, or the panels and graphs of the current view
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='showHidePage'),
+    Output('home-page', 'style'),
     Output('filter-panel', 'style'), 
     Output('rightColumn', 'style'), 
     Output('leftColumn', 'style'), 
+    Output('map-content', 'style'),
+    Output('correlations-content', 'style'),
+    Output('trends-content', 'style'),
     Input('url', 'pathname'))
-def show_hide_homepage(pathname):
-    show = {'display': 'block'}
-    hide = {'display': 'none'}
-    if pathname in ['/map', '/correlations', '/trends']:
-        return hide, show, show, show
-    
-    return show, hide, hide, hide
+
+# Update the dataset year dropdown when years are added to or removed from the dataset directory.
+# This needs the dataset directory, so it runs on the server.
+@app.callback(Output('dataset-year', 'options'), Input('dataset-year-poll', 'n_intervals'),
+              State('dataset-year', 'options'))
+def update_dataset_years(n_intervals, options):
+    new_options = dataset_year_options()
+    if new_options == options:
+        return dash.no_update
+    return new_options
 
 # Changing the left panel based on the url
 @app.callback(Output('panel-content', 'children'),
@@ -157,35 +210,42 @@ def display_options(pathname):
         return []
     # You could also return a 404 "URL not found" page here
 
-# This is a onClick handler for adding a filter option to a selected attribute
+# Small histogram of the number of accidents that is shown above the slider of a filter
+def filter_histogram(counts):
+    fig = go.Figure(go.Bar(y=counts))
+    fig.update_layout(
+        xaxis={'visible': False, 'showticklabels': False}, 
+        yaxis={'visible': False, 'showticklabels': False},
+        margin=dict(l=20, r=20, t=0, b=0),
+        paper_bgcolor='rgba(0,0,0,0)',
+        bargap=0,
+    )
+    return fig
+
+# The label of a value in the filter dropdown, with the number of accidents that have the value
+def filter_option_label(attrib, value, count):
+    if attrib == "region":
+        value = ID_TO_REGION.get(value, value)
+    elif attrib == "local_district":
+        value = ID_TO_LOCAL_DISTRICT.get(value, value)
+    return "{} ({:,})".format(value, count)
+
+# This is a onClick handler for adding a filter option to a selected attribute.
+# The values and histograms come from the domains that are stored with every year, not from the data.
 @app.callback(Output({"type": "filter-attribute-action", "index": MATCH}, "children"),
               Input({"type": "filter-attribute-dropdown", "index": MATCH}, "value"),
               State({"type": "filter-attribute-action", "index": MATCH}, 'id'),
               State("dataset-year", "value"))
 def add_filter_option(attrib, id, year):
+    domains = dataset_domains(dataset_years(year))
     # Dynamically create filter option based on the selected attribute type (i.e. Categorical)
-    df = get_data(year)
     if (attrib in QUANTITATIVE_ATTRIBS):
-        column = df[attrib]
-        x = attrib
-        if (attrib == "time"):
-            column = df["time_index"]
-            x = "time_index"
-        
-        # Get min and max for quantitative attribute
-        val_min = column.min()
-        val_max = column.max()
-        fig = px.histogram(df, x=x)
-        fig.update_layout(
-            xaxis={'visible': False, 'showticklabels': False}, 
-            yaxis={'visible': False, 'showticklabels': False},
-            margin=dict(l=20, r=20, t=0, b=0),
-            paper_bgcolor='rgba(0,0,0,0)',
-        )
+        # The number of accidents per time bucket of the count cube
+        fig = filter_histogram(domains["time"])
         return [
             dcc.Graph(figure=fig, style={"margin-bottom": "8px"}),
             dcc.RangeSlider(className=attrib, id={"type": "filter-action-slider", \
-            "index": id["index"]}, value=[val_min, val_max], min=val_min, max=val_max, \
+            "index": id["index"]}, value=[0, 2359], min=0, max=2359, \
             step=None, 
             marks={
                 # Labels for the filter slider, since Time is the only quantitative attribute (non-derived)
@@ -203,29 +263,40 @@ def add_filter_option(attrib, id, year):
                     html.Label(id={"type": "slider-label-start", "index": id["index"]} ,children = "00:00"),
                     html.Label(id={"type": "slider-label-end", "index": id["index"]} ,children = "23:59")
             ])]
+    # The date is filtered on a range of days of the year, months are used as labels
+    elif (attrib == "date"):
+        fig = filter_histogram(domains["date"])
+        return [
+            dcc.Graph(figure=fig, style={"margin-bottom": "8px"}),
+            dcc.RangeSlider(className=attrib, id={"type": "filter-action-slider", \
+            "index": id["index"]}, value=[1, 366], min=1, max=366, step=1,
+            marks={
+                # First day of every month in a leap year
+                1: {'label': "Jan"},
+                32: {'label': "Feb"},
+                61: {'label': "Mar"},
+                92: {'label': "Apr"},
+                122: {'label': "May"},
+                153: {'label': "Jun"},
+                183: {'label': "Jul"},
+                214: {'label': "Aug"},
+                245: {'label': "Sep"},
+                275: {'label': "Oct"},
+                306: {'label': "Nov"},
+                336: {'label': "Dec"}
+            }), html.Div(style={"display": "flex", "justify-content": "space-between"}, 
+                children=[
+                    html.Label(id={"type": "slider-label-start", "index": id["index"]} ,children = DAY_LABELS[0]),
+                    html.Label(id={"type": "slider-label-end", "index": id["index"]} ,children = DAY_LABELS[-1])
+            ])]
     # Show options based on which categorical attribute was selected
     # After choosing an attribute, another dropdown appears just below it
     # that shows all distinct values within that attribute. 
     # The dropdown allows the user to select multiple values. (for filtering
     # purposes)
     elif (attrib in CATEGORICAL_ATTRIBS or attrib in LOCATION_ATTRIBS):
-        options = []
-        if attrib == "light_conditions":
-            options = [{'label': x, 'value': x} for x in LIGHT_CONDITIONS]
-        if attrib == "special_conditions_at_site":
-            options =  [{'label': x, 'value': x} for x in SPECIAL_CONDITIONS_AT_SITE]
-        if attrib == "road_surface_conditions":
-            options =  [{'label': x, 'value': x} for x in ROAD_SURFACE_CONDITIONS]
-        if attrib == "junction_control":
-            options = [{'label': x, 'value': x} for x in JUNCTION_CONTROL]
-        if attrib == "junction_detail":
-            options = [{'label': x, 'value': x} for x in JUNCTION_DETAIL]
-        if attrib == "speed_limit":
-            options = [{'label': x, 'value': x} for x in SPEED_LIMIT]
-        if attrib == "region":
-            options = [{'label': x[1], 'value': x[0]} for x in ID_TO_REGION.items()]
-        if attrib == "local_district":
-            options = [{'label': x[1], 'value': x[0]} for x in ID_TO_LOCAL_DISTRICT.items()]
+        options = [{'label': filter_option_label(attrib, value, count), 'value': value}
+                   for value, count in domains["values"].get(attrib, [])]
         return dcc.Dropdown(className=attrib, id={"type": "filter-action-select", "index": id["index"]}, multi=True, options=options, value="")
 
 # This is a onClick handler for creating new attribute filter
@@ -262,30 +333,13 @@ def create_filter(n_clicks, filterSection):
     )
     return filterSection
 
-# Callback function for reacting to slider value changes
-@app.callback(
+# Callback function for reacting to slider value changes, formats the labels in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='sliderLabel'),
     Output({"type": "slider-label-start", "index": MATCH}, "children"),
     Output({"type": "slider-label-end", "index": MATCH}, "children"),
-    Input({"type": "filter-action-slider", "index": MATCH}, "value"))
-def display_slider_label(interval):
-    temp_1 = interval[0]
-    temp_2 = interval[1]
-    start = ""
-    end = ""
-    if (temp_1 < 1000):
-        start = "0{}:{}".format(str(temp_1)[0], str(temp_1)[1:])
-        if (temp_1 == 0):
-            start = "00:00"
-    else:
-        start = "{}:{}".format(str(temp_1)[0: 2], str(temp_1)[2:])
-
-    if (temp_2 < 1000):
-        if (temp_2 == 0):
-            start = "00:00"
-        end = "0{}:{}".format(str(temp_2)[0], str(temp_2)[1:])
-    else:
-        end = "{}:{}".format(str(temp_2)[0: 2], str(temp_2)[2:])
-    return start, end
+    Input({"type": "filter-action-slider", "index": MATCH}, "value"),
+    State({"type": "filter-action-slider", "index": MATCH}, "className"))
 
 
 # Callbacks for user-defined filters
@@ -304,202 +358,233 @@ def filter_by_attributes(list_filter_categorical, list_filter_quantitative, list
     # Dumps filter in JSON in a placeholder div that is invisible
     return json.dumps(filter_dict)
 
-
-# Changing the right panel based on the url
-@app.callback(Output('graph-content', 'children'),
-                [Input('url', 'pathname'),
-                Input('dataset-year', 'value'),  
-                # Map Options
-                Input({'type': 'map-attrib', 'index': ALL}, 'value'),
-                Input({'type': 'map-colorscale-seq', 'index': ALL}, 'value'),
-
-                # Correlations Options
-                Input({'type': 'correlations-attrib-x', 'index': ALL}, 'value'),
-                Input({'type': 'correlations-attrib-y', 'index': ALL}, 'value'),
-                Input({'type': 'correlations-colorscale-seq', 'index': ALL}, 'value'),
-                Input({'type': 'correlations-colorscale-disc', 'index': ALL}, 'value'),
-                Input({'type': 'correlations-sorting-order', 'index': ALL}, 'value'),
-                Input({'type': 'correlations-kmeans', 'index': ALL}, 'value'),
-
-                # Trends Options
-                Input({'type': 'trends-attrib', 'index': ALL}, 'value'),
-                Input({'type': 'trends-colorscale-disc', 'index': ALL}, 'value'),
-
-                # Filter
-                Input("btn-apply-filter", "n_clicks"),
-                State("placeholder", "children")
-            ])
-def display_graphs(pathname, year, map_attribs, map_color_seq, corr_attrib_x, corr_attrib_y,
-                   corr_color_seq, corr_color_disc, corr_sort_order, k_means, trends_attribs, trends_color_disc, n_clicks, filter_json):
-    if pathname == '/home':
-        return []
-    
-    df = get_data(year)
-    df_filtered = df.copy()
-    # Parse filter_dict in json format that is stored in "#placeholder"
-    filter_dict = json.loads(filter_json)
-    # If the apply button is clicked and the filter is not empty
-    if (n_clicks != 0) and (len(filter_dict) != 0):
-        # Filter dataset
-        df_filtered = filter_dataset(df, filter_dict)
-    if pathname == '/map':
-        regions = []
-        if 'region' in filter_dict:
-            regions = filter_dict['region']
-        return make_map_graphs(df_filtered, regions, map_attribs[0], get_seq_cont_color(map_color_seq[0]))
-    elif pathname == '/correlations':
-        temp_data = make_correlations_graphs(df_filtered, corr_attrib_x[0], corr_attrib_y[0],
-                                             get_seq_cont_color(corr_color_seq[0]),
-                                             get_disc_color(corr_color_disc[0]), corr_sort_order[0], k_means[0], k_means[1])
-        if temp_data:
-            storage.update(temp_data["dataframe"])
-            return temp_data['children']
-        return temp_data
-
-    elif pathname == '/trends':
-        other_df = get_data(trends_attribs[0])
-        other_df_filtered = other_df.copy()
-        # If the apply button is clicked and the filter is not empty
-        if (n_clicks != 0) and (len(filter_dict) != 0):
-            # Filter dataset
-            other_df_filtered = filter_dataset(other_df, filter_dict)
-        return make_trends_graphs(df_filtered, other_df_filtered, trends_attribs[1], get_disc_color(trends_color_disc[0]))
-    else:
-        return []
-    # You could also return a 404 "URL not found" page here
-
-@app.callback(
-    Output({'type': 'correlations-graph', 'index': ALL}, 'figure'), 
-        Input({'type': 'correlations-graph', 'index': ALL}, 'selectedData'),
-    [
-        State({'type': 'correlations-attrib-x', 'index': ALL}, 'value'),
-        State({'type': 'correlations-attrib-y', 'index': ALL}, 'value'),
-        State({'type': 'correlations-colorscale-seq', 'index': ALL}, 'value'),
-        State({'type': 'correlations-colorscale-disc', 'index': ALL}, 'value'),
-    ])
-def update_brushing(selected_data, corr_atrib_x, corr_atrib_y, color_seq, color_disc):
-    # If there are no two graphs, don't change anything.
-    if len(selected_data) != 2:
-        return dash.no_update
-
-    # If the selected data changed for graph 0.
-    if "\"index\":0" in dash.callback_context.triggered[0]['prop_id'] and selected_data[0] != None:
-        # Update the second graph and leave the first the same.
-        return [
-            dash.no_update, 
-            update_figure_histogram(storage.get(), corr_atrib_x[0], corr_atrib_y[0], selected_data[0], get_disc_color(color_disc[0]))
-        ]
-    elif "\"index\":1" in dash.callback_context.triggered[0]['prop_id'] and selected_data[1] != None:
-        # Update the first graph and leave the second the same.
-        return [
-            update_figure_scatter(storage.get(), corr_atrib_x[0], corr_atrib_y[0], selected_data[1], color_seq[0]), 
-            dash.no_update
-        ]
-    
-    # Should never reach this, just in case.
-    return dash.no_update
-
-
-def update_figure_scatter(df, attrib1, attrib2, selectedpoints, corr_color_seq):
-    # Create updated scatterplot
-    fig = px.scatter(df, x=attrib1, y=attrib2, color='fatality_rate', height=800,
-                     color_continuous_scale=corr_color_seq, labels={'fatality_rate': 'Fatality Rate(%)'})
-    fig.update_layout(
-        yaxis_zeroline=False,
-        xaxis_zeroline=False,
-        dragmode='select'
-    )
-    # disable pan/zoom
-    fig.update_xaxes(fixedrange=True)
-    fig.update_yaxes(fixedrange=True)
-
-    # highlight points with selection other graph
-    if selectedpoints is None:
-        selected_index = df.index  # show all
-    else:
-        selected_index = [  # show only selected indices
-            point['curveNumber']
-            for point in selectedpoints['points']
-        ]
-
-    # Update selected and unselected points with colors accordingly
-    fig.update_traces(
-        mode='markers',
-        marker_size=20,
-        #Selected indexes
-        selectedpoints=selected_index,
-        # color of selected points
-        selected=dict(marker=dict(opacity=1.0)),
-        # color of unselected pts
-        unselected=dict(marker=dict(opacity=0.2))
-    )
-
-    # update axis titles
-    fig.update_layout(
-        xaxis_title=attrib1.replace("_", " ").title(),
-        yaxis_title=attrib2.replace("_", " ").title(),
-    )
-
-    return fig
-
-def update_figure_histogram(df, attrib1, attrib2, selectedpoints, corr_color_disc):
-    # Create updated histogram
-    fig = px.histogram(df, x=attrib1, y=attrib2, color=attrib1, height=800,
-                       nbins=df.index.unique().size, color_discrete_sequence=corr_color_disc,
-                       labels={attrib1: attrib1.replace("_", " ").title()})
-
-    fig.update_layout(
-        yaxis_zeroline=False,
-        xaxis_zeroline=False,
-        dragmode='select'
-    )
-    # disable pan/zoom
-    fig.update_xaxes(fixedrange=True)
-    fig.update_yaxes(fixedrange=True)
-
-    # highlight points with selection other graph
-    if selectedpoints is None:
-        selected_index = df.index  # show all
-    else:
-        selected_index = [  # show only selected indices
-            point['pointIndex']
-            for point in selectedpoints['points']
-        ]
-
-    fig.update_traces(
-        # color of selected points
-        selected=dict(marker=dict(opacity=1.0)),
-        # color of unselected pts made dim
-        unselected=dict(marker=dict(opacity=0.2))
-    )
-
-    # obtain unselected indexes
-    current_indexes = [ x for x in range( len(fig.data) ) ]
-    unselected_indexes = [x for x in current_indexes if x not in selected_index]
-
-    for point in unselected_indexes:
-        fig.data[point].update(
-            selectedpoints=selected_index
-        )
-
-    # update axis titles
-    fig.update_layout(
-        xaxis_title=attrib1.replace("_", " ").title(),
-        yaxis_title=attrib2.replace("_", " ").title(),
-    )
-
-    return fig
-
-
-# Read and pre-process dta
-def get_data(year):
-    df = pd.read_csv(
-        os.getcwd() + "/datasets/road_safety_" + str(year) + ".csv")
-    df_valid = remove_missing_value(df)
-    df = id_to_value(df_valid)
-    # Add "time as integer" as a new column
-    df['time_index'] = pd.to_numeric(df["time"].str.replace(':','')).astype("int")
-    return df
+# Preview the number of accidents that match the filters while they are edited, so a filter that
+# matches nothing is seen before it is applied. Only the totals are counted, from the count cube
+# or the bitmap index of the years.
+@app.callback(Output("filter-preview", "children"),
+              Input("placeholder", "children"),
+              Input("dataset-year", "value"),
+              Input({'type': 'through-year', 'index': ALL}, 'value'))
+def update_filter_preview(filter_json, year, through_year):
+    if filter_json is None:
+        raise PreventUpdate
+    df_counts = aggregate_years(year_span(year, through_year), [], json.loads(filter_json))
+    return "Matching accidents: {:,} ({:,} fatal)".format(int(df_counts['accident_count'].sum()),
+                                                          int(df_counts['fatal_count'].sum()))
+
+# The years from the dataset year through the year selected in the through-year dropdown
+def year_span(year, through_year):
+    if year == ALL_YEARS or len(through_year) == 0 or through_year[0] is None:
+        return dataset_years(year)
+    return list(range(min(year, through_year[0]), max(year, through_year[0]) + 1))
+
+# The filter that was applied with the apply button, the filter_dict is stored in "#placeholder"
+def applied_filter(n_clicks, filter_json):
+    # The filter is only used after the apply button is clicked
+    if n_clicks == 0:
+        return {}
+    return json.loads(filter_json)
+
+# The number of (fatal) accidents per group are kept in the dcc.Store of a view as a dict of columns
+def counts_to_store(df_counts):
+    return {column: df_counts[column].tolist() for column in df_counts.columns}
+
+def counts_from_store(counts):
+    return pd.DataFrame(counts)
+
+# Every view has three callbacks:
+#   - the counts of the view are computed when the data of the view changes (year, filter, attributes),
+#     using the count cube of the years where possible, and kept in the dcc.Store of the view
+#   - the graphs are made from the stored counts when the counts or the type of graph change. The
+#     version of the counts is stored with them, so views that were made before are taken from the figure cache
+#   - the colors and sorting order are changed in the existing figures, without pandas
+
+# Count the accidents of the map per region, or per local district when filtering on regions
+@app.callback(Output('map-counts', 'data'),
+              Input('url', 'pathname'),
+              Input('dataset-year', 'value'),
+              Input({'type': 'through-year', 'index': ALL}, 'value'),
+              Input("btn-apply-filter", "n_clicks"),
+              State("placeholder", "children"))
+def update_map_counts(pathname, year, through_year, n_clicks, filter_json):
+    if pathname != '/map':
+        raise PreventUpdate
+    filter_dict = applied_filter(n_clicks, filter_json)
+    regions = []
+    if 'region' in filter_dict:
+        regions = filter_dict['region']
+    group_by = ['region', 'local_district'] if regions else ['region']
+    years = year_span(year, through_year)
+    df_counts = aggregate_years(years, group_by, filter_dict)
+    return {"version": counts_version(years, group_by, filter_dict), "regions": regions,
+            "counts": counts_to_store(df_counts)}
+
+@app.callback(Output('map-content', 'children'),
+              Input('map-counts', 'data'),
+              Input({'type': 'map-attrib', 'index': ALL}, 'value'),
+              State({'type': 'map-colorscale-seq', 'index': ALL}, 'value'))
+def update_map_graphs(data, map_attribs, map_color_seq):
+    if data is None or len(map_attribs) == 0:
+        raise PreventUpdate
+    key = figure_key('map', data["version"], map_attribs[0], map_color_seq[0])
+    children = get_figures(key)
+    if children is None:
+        children = make_map_graphs(counts_from_store(data["counts"]), data["regions"], map_attribs[0],
+                                   get_seq_cont_color(map_color_seq[0]))
+        put_figures(key, children)
+    return children
+
+# Change the color scale of the map in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='restyleMap'),
+    Output({'type': 'map-graph', 'index': ALL}, 'figure'),
+    Input({'type': 'map-colorscale-seq', 'index': ALL}, 'value'),
+    State({'type': 'map-graph', 'index': ALL}, 'figure'),
+    State('clientside-config', 'data'))
+
+# Count the accidents of the correlations view by the chosen attributes
+@app.callback(Output('correlations-counts', 'data'),
+              Input('url', 'pathname'),
+              Input('dataset-year', 'value'),
+              Input({'type': 'correlations-attrib-x', 'index': ALL}, 'value'),
+              Input({'type': 'correlations-attrib-y', 'index': ALL}, 'value'),
+              Input({'type': 'correlations-attrib-more', 'index': ALL}, 'value'),
+              Input("btn-apply-filter", "n_clicks"),
+              State("placeholder", "children"))
+def update_correlations_counts(pathname, year, corr_attrib_x, corr_attrib_y, corr_attrib_more, n_clicks, filter_json):
+    if pathname != '/correlations' or len(corr_attrib_x) == 0:
+        raise PreventUpdate
+    group_by = correlations_group_by(corr_attrib_x[0], corr_attrib_y[0], corr_attrib_more[0])
+    # No plotting when an attribute is missing
+    if not group_by:
+        return None
+    years = dataset_years(year)
+    filter_dict = applied_filter(n_clicks, filter_json)
+    df_counts = aggregate_years(years, group_by, filter_dict)
+    return {"version": counts_version(years, group_by, filter_dict), "attrib1": corr_attrib_x[0],
+            "attrib2": corr_attrib_y[0], "counts": counts_to_store(df_counts)}
+
+# Show the graphs made by make_correlations_graphs, and keep them in the figure cache
+def show_correlations_graphs(children, key):
+    put_figures(key, children)
+    return children
+
+# Make the correlations graphs. Graphs that take long to make are made by a background job, while
+# the job runs the correlations-poll interval checks whether it is done. The job is kept with the
+# figure key of the settings it was submitted with, its graphs are cached under that key.
+@app.callback(Output('correlations-content', 'children'),
+              Output('correlations-job', 'data'),
+              Output('correlations-poll', 'disabled'),
+              Output('correlations-restyle', 'data'),
+              Input('correlations-counts', 'data'),
+              Input({'type': 'correlations-kmeans', 'index': ALL}, 'value'),
+              Input('correlations-poll', 'n_intervals'),
+              State({'type': 'correlations-colorscale-seq', 'index': ALL}, 'value'),
+              State({'type': 'correlations-colorscale-disc', 'index': ALL}, 'value'),
+              State({'type': 'correlations-sorting-order', 'index': ALL}, 'value'),
+              State('correlations-job', 'data'))
+def update_correlations_graphs(data, k_means, n_intervals, corr_color_seq, corr_color_disc, corr_sort_order, job):
+    if len(k_means) == 0:
+        raise PreventUpdate
+    polling = "correlations-poll" in dash.callback_context.triggered[0]['prop_id']
+    if not polling and job is not None:
+        # The inputs changed, the result of the running job is no longer needed
+        jobs.cancel(job["id"])
+    if data is None:
+        return [], None, True, dash.no_update
+
+    key = figure_key('correlations', data["version"], data["attrib1"], data["attrib2"], corr_color_seq[0],
+                     corr_color_disc[0], corr_sort_order[0], k_means[0], k_means[1])
+    children = get_figures(key)
+    if children is not None:
+        if polling:
+            jobs.cancel(job["id"])
+        return children, None, True, dash.no_update
+
+    args = (counts_from_store(data["counts"]), data["attrib1"], data["attrib2"],
+            get_seq_cont_color(corr_color_seq[0]), get_disc_color(corr_color_disc[0]),
+            corr_sort_order[0], k_means[0], k_means[1])
+    if polling:
+        status = jobs.status(job["id"])
+        if status in ["pending", "running"]:
+            return [html.P("Computing the graphs... ({:.0f} s)".format(jobs.elapsed(job["id"])))], \
+                   dash.no_update, False, dash.no_update
+        if status == "failed":
+            try:
+                jobs.pop_result(job["id"])
+            except Exception:
+                traceback.print_exc()
+            return [html.P("The graphs could not be made.")], None, True, dash.no_update
+        if status == "done":
+            children = show_correlations_graphs(jobs.pop_result(job["id"]), job["key"])
+            # The colors or the sorting order changed while the job ran
+            return children, None, True, (key if job["key"] != key else dash.no_update)
+        # The job is not known (anymore), e.g. its result expired, make the graphs here instead
+        return show_correlations_graphs(make_correlations_graphs(*args), key), None, True, dash.no_update
+
+    if is_heavy(data["attrib1"], data["attrib2"], k_means[0]):
+        job = {"id": jobs.submit(make_correlations_graphs, *args), "key": key}
+        return [html.P("Computing the graphs...")], job, False, dash.no_update
+    return show_correlations_graphs(make_correlations_graphs(*args), key), None, True, dash.no_update
+
+# Count the accidents per day of every year of the span and of the other year
+@app.callback(Output('trends-counts', 'data'),
+              Input('url', 'pathname'),
+              Input('dataset-year', 'value'),
+              Input({'type': 'through-year', 'index': ALL}, 'value'),
+              Input({'type': 'trends-year', 'index': ALL}, 'value'),
+              Input("btn-apply-filter", "n_clicks"),
+              State("placeholder", "children"))
+def update_trends_counts(pathname, year, through_year, other_year, n_clicks, filter_json):
+    if pathname != '/trends' or len(other_year) == 0:
+        raise PreventUpdate
+    years = year_span(year, through_year)
+    # There is no other year when only one year is available or the dropdown was cleared
+    if other_year[0] is not None:
+        years = years + [other_year[0]]
+    group_by = ['accident_year', 'day_of_year']
+    filter_dict = applied_filter(n_clicks, filter_json)
+    df_counts = aggregate_years(years, group_by, filter_dict)
+    return {"version": counts_version(years, group_by, filter_dict), "counts": counts_to_store(df_counts)}
+
+@app.callback(Output('trends-content', 'children'),
+              Input('trends-counts', 'data'),
+              Input({'type': 'trends-attrib', 'index': ALL}, 'value'),
+              State({'type': 'trends-colorscale-disc', 'index': ALL}, 'value'))
+def update_trends_graphs(data, trends_attribs, trends_color_disc):
+    if data is None or len(trends_attribs) == 0:
+        raise PreventUpdate
+    key = figure_key('trends', data["version"], trends_attribs[0], trends_color_disc[0])
+    children = get_figures(key)
+    if children is None:
+        children = make_trends_graphs(counts_from_store(data["counts"]), trends_attribs[0],
+                                      get_disc_color(trends_color_disc[0]))
+        put_figures(key, children)
+    return children
+
+# Change the colors of the trend lines in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='restyleTrends'),
+    Output({'type': 'trends-graph', 'index': ALL}, 'figure'),
+    Input({'type': 'trends-colorscale-disc', 'index': ALL}, 'value'),
+    State({'type': 'trends-graph', 'index': ALL}, 'figure'),
+    State('clientside-config', 'data'))
+
+# Brushing highlights the points selected in one correlations graph in the other graph, and the colors
+# and sorting order change the existing figures. Both change the figures, so they are applied by one
+# clientside callback.
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='correlationsFigures'),
+    Output({'type': 'correlations-graph', 'index': ALL}, 'figure'),
+    Input({'type': 'correlations-graph', 'index': ALL}, 'selectedData'),
+    Input({'type': 'correlations-colorscale-seq', 'index': ALL}, 'value'),
+    Input({'type': 'correlations-colorscale-disc', 'index': ALL}, 'value'),
+    Input({'type': 'correlations-sorting-order', 'index': ALL}, 'value'),
+    Input('correlations-restyle', 'data'),
+    State({'type': 'correlations-attrib-x', 'index': ALL}, 'value'),
+    State({'type': 'correlations-kmeans', 'index': ALL}, 'value'),
+    State({'type': 'correlations-graph', 'index': ALL}, 'figure'),
+    State('clientside-config', 'data'))
 
 # This is an auxillary method to create filter_dict from lists of attibutes and their selected options
 def create_filter_dict(list_filter, list_attribute):
@@ -512,45 +597,6 @@ def create_filter_dict(list_filter, list_attribute):
             filter_dict[attrib] = list_filter[i]
     return filter_dict
 
-# This is an auxillary method to filter a given dataset using a filter_dict
-def filter_dataset(df, filter_dict):
-    df_filtered = df.copy()
-    # Iterate through each filter option
-    for attrib in filter_dict:
-        filter_options = filter_dict[attrib]
-        # Skip if this attribute has no filter yet
-        if (len(filter_options) == 0):
-            continue
-        if (attrib == "time"): 
-            start = filter_options[0]
-            end = filter_options[1]
-            df_filtered = df_filtered[(df_filtered["time_index"] >= start) & (df_filtered["time_index"] <= end)]
-        else:
-            df_filtered = df_filtered[df_filtered[attrib].isin(filter_options)]
-
-    return df_filtered
-
-
-# Remove rows with missing values for every target attribute
-def remove_missing_value(df):
-    columns = MISSING_VALUE_TABLE.keys()
-    df_processed = df.copy()
-    for attribute in columns:
-        # Iterate through the look up table to remove missing values
-        for missing_value in MISSING_VALUE_TABLE[attribute]:
-            df_processed = df_processed[df_processed[attribute] != missing_value]
-    return df_processed
-
-# Map IDS to the corresponding value
-def id_to_value(df):
-    # Copy data set
-    df_mapped = df.copy()
-    # Replace ID to the actual value
-    return df_mapped.replace({'light_conditions': ID_TO_LIGHT_CONDITIONS, 'junction_detail': ID_TO_JUNCTION_DETAIL, \
-                              'junction_control': ID_TO_JUNCTION_CONTROL,
-                              'road_surface_conditions': ID_TO_ROAD_SURFACE_CONDITIONS, \
-                              'special_conditions_at_site': ID_TO_SPECIAL_CONDITIONS_AT_SITE})
-
 # Method to generate list of time intervals for grouping accidents
 def generate_list_intervals(interval_size):
     time_intervals = []
@@ -572,4 +618,8 @@ def find_closest_interval(row, intervals):
     return closest_interval
 
 if __name__ == '__main__':
+    # Rebuild years of which the csv file changes while the app is running. In debug mode the
+    # reloader runs the app in a child process (with WERKZEUG_RUN_MAIN set), only that one watches.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        watcher.start()
     app.run_server(debug=True)
\ No newline at end of file
@@ -1,7 +1,101 @@
+import os
 from re import M, S
 from ssl import SSL_ERROR_EOF
 from pandas.core.frame import DataFrame
 
+# Directory containing the road_safety_<year>.csv files
+DATASET_DIR = os.path.join(os.getcwd(), "datasets")
+
+# Directory of the columnar store that is built from the csv files
+STORE_DIR = os.path.join(DATASET_DIR, "store")
+
+# Columns of the raw DfT accident files that are used by the app
+RAW_COLUMNS = [
+    'accident_index',
+    'accident_year',
+    'accident_severity',
+    'number_of_vehicles',
+    'number_of_casualties',
+    'date',
+    'time',
+    'region',
+    'local_district',
+    'speed_limit',
+    'light_conditions',
+    'junction_detail',
+    'junction_control',
+    'road_surface_conditions',
+    'special_conditions_at_site',
+]
+
+# Names of columns in the raw DfT accident files that are renamed for the app
+RAW_COLUMN_NAMES = {
+    'police_force': 'region',
+    'local_authority_district': 'local_district',
+}
+
+# Size of the time of day buckets of the count cube, in minutes
+TIME_BUCKET_MINUTES = 60
+
+# Number of cores of the machine (os.cpu_count() is None when it can't be determined)
+CPU_COUNT = os.cpu_count() or 1
+
+# Maximum memory (in bytes) used to keep prepared years in memory
+DATA_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Address, number of worker processes and threads per worker of the production server (see gunicorn.conf.py).
+# The aggregate workers are divided over the server workers (see wsgi.py): with a server worker per core every
+# server worker would get a single aggregate worker and count year spans one year at a time, so there is a
+# server worker per two cores and each of them counts two years at a time.
+SERVER_BIND = "0.0.0.0:8050"
+SERVER_WORKERS = max(2, CPU_COUNT // 2)
+SERVER_THREADS = 4
+
+# Maximum memory (in bytes) used to keep the rows selected by recently used filters
+FILTER_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# Maximum memory (in bytes) used to keep the figures of recently made views
+FIGURE_CACHE_MAX_BYTES = 128 * 1024 ** 2
+
+# Maximum memory (in bytes) used to keep the compressed responses of cached figures
+COMPRESSED_CACHE_MAX_BYTES = 32 * 1024 ** 2
+
+# Compression of the responses, in order of preference when the browser accepts several
+COMPRESS_ALGORITHM = ["br", "gzip"]
+
+# Quality of Brotli compression, from 0 (fastest) to 11 (smallest)
+COMPRESS_BR_LEVEL = 5
+
+# Number of decimals the coordinates of the maps are rounded to, 4 decimals is about 10 meters
+GEOJSON_DECIMALS = 4
+
+# Number of worker processes that count the accidents of the years of a year span in parallel
+AGGREGATE_WORKERS = CPU_COUNT
+
+# Maximum memory (in bytes) used by the worker processes together, when counting several years
+AGGREGATE_MAX_BYTES = 4 * 1024 ** 3
+
+# Value of the dataset year when the views show the accidents of every available year
+ALL_YEARS = "all"
+
+# Number of worker processes that run long computations (e.g. K-Means) in the background
+JOB_WORKERS = 2
+
+# Number of threads every job worker may use for the BLAS and OpenMP libraries
+JOB_THREADS = max(1, CPU_COUNT // JOB_WORKERS)
+
+# Number of seconds after which the result of a background job that was not picked up is removed
+JOB_RESULT_TTL_SECONDS = 10 * 60
+
+# Directory with the state and results of the background jobs, shared by the server processes
+JOB_DIR = os.path.join(DATASET_DIR, "jobs")
+
+# Number of milliseconds between two checks of the browser whether a background job is done
+JOB_POLL_INTERVAL_MS = 500
+
+# Number of seconds between two scans of the dataset directory for new or changed year files
+WATCH_INTERVAL_SECONDS = 30
+
 # Missing value dictionary for preprocessing
 MISSING_VALUE_TABLE = {
     "light_conditions": [-1],
@@ -23,6 +117,7 @@ ALL_ATTRIBUTES = {
     "junction_control",
     "junction_detail",
     "time",
+    "date",
     "speed_limit",
     "region",
 }
@@ -205,6 +300,24 @@ LOCATION_ATTRIBS = [
     'local_district',
 ]
 
+# Rollups of the count cube that is stored next to the prepared data of a year, from small to large.
+# Every rollup counts the accidents for every combination of its dimensions. Crossing all dimensions
+# in one cube would give about one cell per accident, so there is a rollup for every group by and
+# filter of one categorical attribute that the views use: the map (location), the trends (day of
+# the year) and the correlations (pairs of categorical attributes), each also with the time of day.
+CUBE_ROLLUPS = {
+    'time': ['time_bucket'],
+    'date': ['day_of_year'],
+    'location': ['region', 'local_district'],
+    **{attrib: [attrib, 'time_bucket'] for attrib in CATEGORICAL_ATTRIBS},
+    **{attrib1 + '_' + attrib2: [attrib1, attrib2, 'time_bucket']
+       for i, attrib1 in enumerate(CATEGORICAL_ATTRIBS) for attrib2 in CATEGORICAL_ATTRIBS[i + 1:]},
+    **{attrib + '_location': [attrib, 'region', 'local_district'] for attrib in CATEGORICAL_ATTRIBS},
+    **{attrib + '_date': [attrib, 'day_of_year'] for attrib in CATEGORICAL_ATTRIBS},
+    'location_time': ['region', 'local_district', 'time_bucket'],
+    'date_time': ['day_of_year', 'time_bucket'],
+}
+
 SORT_ORDER_OPTIONS = [
     'None',
     'Ascending',
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+import sys
+
+# The config file is loaded before gunicorn adds the app directory to the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import SERVER_BIND, SERVER_WORKERS, SERVER_THREADS
+
+
+# Settings of the production server, run it with:
+#   > gunicorn wsgi:server
+bind = SERVER_BIND
+workers = SERVER_WORKERS
+threads = SERVER_THREADS
+worker_class = "gthread"
+# Load the app and the data in the master process before forking the workers (see wsgi.py)
+preload_app = True
+# Graphs of all years can take a while to make
+timeout = 120
+
+
+# Start the aggregate and job workers of a server worker before it serves requests. The pools are
+# forked from the server worker, which must not have other threads at that moment (see start_aggregate_pool).
+def post_worker_init(worker):
+    from viz_app.query import start_aggregate_pool
+    from viz_app.jobs import jobs
+    start_aggregate_pool()
+    jobs.start()
+
+
+# Start watching the dataset directory when the server is ready. The watcher runs in its own
+# process: the master keeps forking workers, and a thread in the master could hold a lock
+# at that moment. The workers pick up a rebuilt store by its new signature.
+def when_ready(server):
+    from viz_app.watcher import watcher
+    multiprocessing.Process(target=watcher.run, name="dataset-watcher", daemon=True).start()
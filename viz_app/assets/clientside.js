@@ -0,0 +1,178 @@
+// Callbacks that do not need the data on the server run in the browser, see the
+// app.clientside_callback calls in app.py. The palettes and attribute types they
+// need are stored in the "clientside-config" dcc.Store of the layout.
+
+// A copy of a figure with some of its layout changed
+function withLayout(figure, layout) {
+    return Object.assign({}, figure, {layout: Object.assign({}, figure.layout, layout)});
+}
+
+// A continuous color scale with the colors of a palette at equal distances
+function makeColorscale(colors) {
+    return colors.map(function (color, i) {
+        return [i / (colors.length - 1), color];
+    });
+}
+
+// A copy of a figure with a new color scale, if it has a color axis
+function withColorscale(figure, colors) {
+    if (!figure.layout.coloraxis) {
+        return figure;
+    }
+    return withLayout(figure, {
+        coloraxis: Object.assign({}, figure.layout.coloraxis, {colorscale: makeColorscale(colors)})
+    });
+}
+
+// The order of the categories on the x axis for a sorting order, see add_sort_order
+function categoryOrder(sortOrder) {
+    return {
+        'None': 'category ascending',
+        'Ascending': 'total ascending',
+        'Descending': 'total descending',
+    }[sortOrder];
+}
+
+// Brushing of the scatter plot (graph 0) and the histogram (graph 1) of the correlations view.
+// Point i of the scatter plot and trace i of the histogram are the same category, so the
+// categories selected in one graph are highlighted in the other graph by their index.
+function brush(figure, selectedData, source) {
+    if (!selectedData) {
+        // Nothing is selected anymore, show every point
+        return Object.assign({}, figure, {data: figure.data.map(function (trace) {
+            return Object.assign({}, trace, {selectedpoints: null});
+        })});
+    }
+    var selected = new Set(selectedData.points.map(function (point) {
+        return source === 0 ? point.pointIndex : point.curveNumber;
+    }));
+    var data;
+    if (source === 0) {
+        // The histogram has one bar per trace, the bar is dimmed when its category is not selected
+        data = figure.data.map(function (trace, i) {
+            return Object.assign({}, trace, {selectedpoints: selected.has(i) ? null : []});
+        });
+    } else {
+        data = figure.data.map(function (trace) {
+            return Object.assign({}, trace, {selectedpoints: Array.from(selected)});
+        });
+    }
+    return Object.assign({}, figure, {data: data});
+}
+
+function pad(number) {
+    return (number < 10 ? '0' : '') + number;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    clientside: {
+        // Labels of a filter slider: HH:MM for a time of day given as HHMM,
+        // MM/DD for a day of the year
+        sliderLabel: function (interval, attrib) {
+            if (attrib === 'date') {
+                return interval.map(function (day) {
+                    // Days are counted in a leap year
+                    var date = new Date(Date.UTC(2000, 0, day));
+                    return pad(date.getUTCMonth() + 1) + '/' + pad(date.getUTCDate());
+                });
+            }
+            return interval.map(function (time) {
+                return pad(Math.floor(time / 100)) + ':' + pad(time % 100);
+            });
+        },
+
+        // Show the home page, or the panels and graphs of the current view
+        showHidePage: function (pathname) {
+            var show = {'display': 'block'};
+            var hide = {'display': 'none'};
+            var views = ['/map', '/correlations', '/trends'].map(function (path) {
+                return pathname === path ? show : hide;
+            });
+            if (views.indexOf(show) >= 0) {
+                return [hide, show, show, show].concat(views);
+            }
+            return [show, hide, hide, hide].concat(views);
+        },
+
+        // The K-Means settings are only shown when both attributes are quantitative
+        kmeansSettings: function (attribX, attribY, config) {
+            var quantitative = config.quantitative;
+            if (quantitative.indexOf(attribX[0]) >= 0 && quantitative.indexOf(attribY[0]) >= 0) {
+                return {'display': 'block'};
+            }
+            return {'display': 'none'};
+        },
+
+        // Change the color scale of the map
+        restyleMap: function (colorscale, figures, config) {
+            if (figures.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return figures.map(function (figure) {
+                return withColorscale(figure, config.sequential[colorscale[0]]);
+            });
+        },
+
+        // Change the colors of the lines of the trend graph
+        restyleTrends: function (colorscale, figures, config) {
+            if (figures.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var colors = config.qualitative[colorscale[0]];
+            return figures.map(function (figure) {
+                var data = figure.data.map(function (trace, i) {
+                    var line = Object.assign({}, trace.line, {color: colors[i % colors.length]});
+                    return Object.assign({}, trace, {line: line});
+                });
+                return Object.assign({}, figure, {data: data});
+            });
+        },
+
+        // Brushing of the correlations graphs, or the existing figures with other
+        // colors or another sorting order (also when the graphs of a job were made with other settings)
+        correlationsFigures: function (selectedData, colorscaleSeq, colorscaleDisc, sortOrder, restyle,
+                                       attribX, kmeans, figures, config) {
+            if (figures.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var brushed = window.dash_clientside.callback_context.triggered.filter(function (t) {
+                return t.prop_id.endsWith('.selectedData');
+            });
+            if (brushed.length > 0) {
+                // Only the scatter plot and histogram can be brushed
+                if (figures.length !== 2) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var propId = brushed[0].prop_id;
+                var source = JSON.parse(propId.slice(0, propId.lastIndexOf('.'))).index;
+                return figures.map(function (figure, i) {
+                    return i === source ? window.dash_clientside.no_update
+                                        : brush(figure, selectedData[source], source);
+                });
+            }
+
+            // Clusters of K-Means get the discrete colors
+            var useKmeans = config.quantitative.indexOf(attribX[0]) >= 0 && kmeans[0].indexOf('k_means') >= 0;
+            var sequential = config.sequential[colorscaleSeq[0]];
+            var discrete = config.qualitative[colorscaleDisc[0]];
+            var order = categoryOrder(sortOrder[0]);
+            return figures.map(function (figure) {
+                figure = withColorscale(figure, useKmeans ? discrete : sequential);
+                var histogram = 0;
+                var data = figure.data.map(function (trace) {
+                    if (trace.type !== 'histogram') {
+                        return trace;
+                    }
+                    var marker = Object.assign({}, trace.marker, {color: discrete[histogram++ % discrete.length]});
+                    return Object.assign({}, trace, {marker: marker});
+                });
+                figure = Object.assign({}, figure, {data: data});
+                // The parallel categories diagram has no x axis
+                if (order && data.length > 0 && data[0].type !== 'parcats') {
+                    figure = withLayout(figure, {xaxis: Object.assign({}, figure.layout.xaxis, {categoryorder: order})});
+                }
+                return figure;
+            });
+        },
+    },
+});
@@ -0,0 +1,143 @@
+import numpy as np
+
+from config import CATEGORICAL_ATTRIBS, LOCATION_ATTRIBS
+
+
+# The minutes since midnight of a time filter ([start, end] as HHMM) as a half-open range [start, end).
+# The time slider stops at whole hours, so a filter from 08:00 to 09:00 has the accidents of one hour.
+# The end of the slider (23:59) includes the last minute of the day.
+def time_filter_minutes(time_range):
+    start = time_range[0] // 100 * 60 + time_range[0] % 100
+    end = 24 * 60 if time_range[1] >= 2359 else time_range[1] // 100 * 60 + time_range[1] % 100
+    return start, end
+
+
+# Sorted permutation index of a numeric column: the row numbers ordered by value, next to the
+# sorted values. The rows with a value in a range are a contiguous slice of the permutation that
+# is found with a binary search, so finding them costs O(log n + k) instead of comparing every row.
+class SortedIndex:
+
+    def __init__(self, values):
+        self.order = np.argsort(values, kind='stable').astype(np.int32)
+        self.values = values[self.order]
+
+    # Row numbers with a value in [low, high]
+    def rows(self, low, high):
+        # Bounds of the type of the values, numpy would otherwise convert all values to the type of the bounds
+        low, high = self.values.dtype.type(low), self.values.dtype.type(high)
+        start = np.searchsorted(self.values, low, side='left')
+        end = np.searchsorted(self.values, high, side='right')
+        return self.order[start:end]
+
+    def nbytes(self):
+        return self.order.nbytes + self.values.nbytes
+
+
+# Bitmap index of the prepared data of a year. For every value of the categorical and location
+# attributes it has a packed bitset with one bit per row that is set when the row has that value.
+# The time of day and the date, which are filtered on a range, have a SortedIndex instead.
+# A filter_dict is applied with these bitsets and sorted indexes (see select), instead of scanning
+# and copying the data for every filter.
+class BitmapIndex:
+
+    def __init__(self, df):
+        self.rows = len(df)
+        self.bitmaps = {}
+        for attrib in CATEGORICAL_ATTRIBS + LOCATION_ATTRIBS:
+            self.bitmaps[attrib] = self.build(df[attrib])
+        self.ranges = {
+            'time': SortedIndex(df['time_minutes'].to_numpy()),
+            'date': SortedIndex(df['day_of_year'].to_numpy()),
+        }
+
+    # A bitset for every distinct value of a column
+    def build(self, column):
+        labels = None
+        if column.dtype.name == 'category':
+            # Work on the codes, the labels are only used as keys
+            labels = column.cat.categories
+            column = column.cat.codes
+        bitmaps = {}
+        distinct, inverse = np.unique(column.to_numpy(), return_inverse=True)
+        for i, value in enumerate(distinct):
+            # Skip unknown values (code -1) of categorical columns
+            if labels is not None and value < 0:
+                continue
+            # Use python values as keys, so they match the values of a filter_dict
+            key = labels[value] if labels is not None else value.item()
+            bitmaps[key] = np.packbits(inverse == i)
+        return bitmaps
+
+    # Size of the index in bytes
+    def nbytes(self):
+        size = sum(index.nbytes() for index in self.ranges.values())
+        for bitmaps in self.bitmaps.values():
+            size += sum(bits.nbytes for bits in bitmaps.values())
+        return size
+
+    def empty(self):
+        return np.zeros((self.rows + 7) // 8, dtype=np.uint8)
+
+    # Bitset of the rows that have one of the given values of an attribute
+    def values_bits(self, attrib, values):
+        bits = self.empty()
+        for value in values:
+            if value in self.bitmaps[attrib]:
+                bits |= self.bitmaps[attrib][value]
+        return bits
+
+    # Which of the given rows (row numbers) have one of the given values of an attribute. Only the
+    # bits of those rows are looked up, so this costs O(k) for k rows instead of O(n).
+    def test_rows(self, attrib, values, rows):
+        hits = np.zeros(len(rows), dtype=bool)
+        byte, shift = rows >> 3, 7 - (rows & 7)
+        for value in values:
+            if value in self.bitmaps[attrib]:
+                hits |= (self.bitmaps[attrib][value][byte] >> shift) & 1 == 1
+        return hits
+
+    # The rows of a range filter (time as HHMM, date as days of the year) found with the SortedIndex
+    def range_rows(self, attrib, filter_options):
+        if attrib == "time":
+            # The index has the minutes since midnight
+            start, end = time_filter_minutes(filter_options)
+            return self.ranges[attrib].rows(start, end - 1)
+        return self.ranges[attrib].rows(filter_options[0], filter_options[1])
+
+    # The rows that match a filter_dict, or None if nothing is filtered. Without a time or date filter
+    # the selection is a packed bitset, made with a few bitwise OR (values of one attribute) and AND
+    # (different attributes) operations. With a time or date filter it is the row numbers (in the
+    # order of the values, not of the rows): the k rows in the range are a slice of the SortedIndex,
+    # and only those rows are tested against the bitsets of the other filters, so the selection
+    # costs O(log n + k) instead of O(n).
+    def select(self, filter_dict):
+        filters = {attrib: filter_options for attrib, filter_options in filter_dict.items() if len(filter_options) > 0}
+        if len(filters) == 0:
+            return None
+        rows = None
+        for attrib in self.ranges:
+            if attrib in filters:
+                found = self.range_rows(attrib, filters.pop(attrib))
+                rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        if rows is None:
+            selection = None
+            for attrib, filter_options in filters.items():
+                bits = self.values_bits(attrib, filter_options)
+                selection = bits if selection is None else selection & bits
+            return selection
+        # A copy, so a cached selection does not keep the whole permutation in memory
+        rows = rows.copy()
+        for attrib, filter_options in filters.items():
+            rows = rows[self.test_rows(attrib, filter_options, rows)]
+        return rows
+
+    # Boolean mask of the rows that match a filter_dict, or None if nothing is filtered
+    def mask(self, filter_dict):
+        selection = self.select(filter_dict)
+        if selection is None:
+            return None
+        if selection.dtype == np.uint8:
+            return np.unpackbits(selection, count=self.rows).view(bool)
+        mask = np.zeros(self.rows, dtype=bool)
+        mask[selection] = True
+        return mask
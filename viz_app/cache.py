@@ -0,0 +1,107 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+# A least recently used cache that is bounded by the total size of its values.
+# The size of a value is given when it is added, so the cache can hold anything
+# (dataframes, masks, figures) as long as the caller knows how to measure it.
+class LRUCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # Entries that were made by the parent of a forked process (see share), they are
+        # not counted against max_bytes and never evicted
+        self.shared = {}
+        self.shared_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Dash serves callbacks from multiple threads
+        self.lock = threading.Lock()
+        # A forked process (e.g. a worker of a process pool) gets a new lock: the lock that it copied
+        # may have been held by another thread of its parent, which does not exist in the child
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.shared:
+                self.hits += 1
+                return self.shared[key][0]
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        # Sizes are often numpy integers (e.g. from memory_usage), keep plain ints so stats() is valid json
+        size = int(size)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            # A value larger than the whole budget is not cached at all
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            # Remove the least recently used values until we are within budget again
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    # Remove the least recently used values until the cache holds at most max_bytes,
+    # without changing its budget
+    def trim(self, max_bytes):
+        with self.lock:
+            while self.total_bytes > max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    # Keep the current entries as shared entries. A process that is forked after the entries were made
+    # shares their memory with its parent (copy-on-write), so they cost it nothing and evicting them
+    # would not free any memory. Only the entries made afterwards count against max_bytes.
+    def share(self):
+        with self.lock:
+            self.shared.update(self.entries)
+            self.shared_bytes += self.total_bytes
+            self.entries.clear()
+            self.total_bytes = 0
+
+    # Remove every entry for which the given function returns True
+    def invalidate(self, match):
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                self.total_bytes -= self.entries.pop(key)[1]
+            for key in [key for key in self.shared if match(key)]:
+                self.shared_bytes -= self.shared.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            self.shared.clear()
+            self.shared_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "shared_entries": len(self.shared),
+                "shared_bytes": self.shared_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / max(1, self.hits + self.misses),
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,111 @@
+import numpy as np
+
+from viz_app.bitmap import time_filter_minutes
+from config import CUBE_ROLLUPS, TIME_BUCKET_MINUTES
+
+# The count cube of a year is a set of rollups (CUBE_ROLLUPS), every rollup holds the number of
+# accidents (accident_count) and the number of fatal accidents (fatal_count) for every combination
+# of its dimensions that occurs in the data. Aggregates over the dimensions of one rollup are sums
+# of its cells, so they don't need the rows.
+
+
+# Count the accidents and fatal accidents of a dataframe grouped by the given columns
+def count_rows(df, group_by, dropna=True):
+    is_fatal = df['accident_severity'] == 1
+    grouped = is_fatal.groupby([df[column] for column in group_by], observed=True, dropna=dropna)
+    # Categorical groups are not always sorted when observed=True, so sort them explicitly
+    return grouped.agg(accident_count='size', fatal_count='sum').reset_index().sort_values(group_by, ignore_index=True)
+
+# Build the rollups of the count cube from the prepared data of a year, as a dict of dataframes.
+# Rows with unknown values are kept (dropna=False), so every rollup adds up to the number of rows.
+def build_cube(df):
+    df = df.copy(deep=False)
+    df['time_bucket'] = (df['time_minutes'] // TIME_BUCKET_MINUTES).astype('int8')
+    cube = {}
+    for name, dimensions in CUBE_ROLLUPS.items():
+        rollup = count_rows(df, dimensions, dropna=False)
+        rollup['accident_count'] = rollup['accident_count'].astype('int32')
+        rollup['fatal_count'] = rollup['fatal_count'].astype('int32')
+        cube[name] = rollup
+    return cube
+
+# The time buckets covered by a time filter ([start, end] as HHMM, see time_filter_minutes), or None
+# if the range does not start and end on the boundaries of the buckets
+def time_filter_buckets(time_range):
+    start, end = time_filter_minutes(time_range)
+    if start % TIME_BUCKET_MINUTES != 0 or end % TIME_BUCKET_MINUTES != 0:
+        return None
+    return list(range(start // TIME_BUCKET_MINUTES, end // TIME_BUCKET_MINUTES))
+
+# The smallest rollup of the cube that an aggregate can be computed from instead of the rows,
+# or None if no rollup has every attribute of group_by and filter_dict
+def cube_rollup(group_by, filter_dict):
+    needed = set(group_by)
+    for attrib, filter_options in filter_dict.items():
+        if len(filter_options) == 0:
+            continue
+        if attrib == "time":
+            if time_filter_buckets(filter_options) is None:
+                return None
+            needed.add('time_bucket')
+        elif attrib == "date":
+            needed.add('day_of_year')
+        else:
+            needed.add(attrib)
+    for name, dimensions in CUBE_ROLLUPS.items():
+        if needed.issubset(dimensions):
+            return name
+    return None
+
+# Count the accidents and fatal accidents grouped by the given dimensions, for the
+# accidents that match filter_dict, by adding up the cells of a rollup of the cube (see cube_rollup)
+def query_cube(cube, group_by, filter_dict):
+    mask = np.ones(len(cube), dtype=bool)
+    for attrib, filter_options in filter_dict.items():
+        if len(filter_options) == 0:
+            continue
+        if attrib == "time":
+            mask &= cube['time_bucket'].isin(time_filter_buckets(filter_options)).to_numpy()
+        elif attrib == "date":
+            mask &= cube['day_of_year'].between(filter_options[0], filter_options[1]).to_numpy()
+        else:
+            mask &= cube[attrib].isin(filter_options).to_numpy()
+    if len(group_by) == 0:
+        # Only the total number of accidents
+        return cube.loc[mask, ['accident_count', 'fatal_count']].sum().to_frame().T
+    counts = cube[mask].groupby(group_by, observed=True)[['accident_count', 'fatal_count']].sum()
+    return counts.reset_index().sort_values(group_by, ignore_index=True)
+
+# The values of the dimensions that can be filtered on with their number of accidents, and the number of
+# accidents per time bucket and per day of the year. The filter panel shows these, so adding a filter
+# needs neither the rows nor the cube (see get_domains in viz_app/data.py).
+def build_domains(cube):
+    values = {}
+    for rollup in cube.values():
+        for attrib in rollup.columns:
+            # Every rollup of an attribute has the same counts per value
+            if attrib in values or attrib in ['time_bucket', 'day_of_year', 'accident_count', 'fatal_count']:
+                continue
+            # Unknown values are not counted, they can't be chosen in a filter
+            counts = rollup.groupby(attrib, observed=True)['accident_count'].sum()
+            values[attrib] = [[value.item() if hasattr(value, 'item') else value, int(count)]
+                              for value, count in counts.items()]
+    time = cube['time'].groupby('time_bucket')['accident_count'].sum() \
+               .reindex(range(24 * 60 // TIME_BUCKET_MINUTES), fill_value=0)
+    date = cube['date'].groupby('day_of_year')['accident_count'].sum().reindex(range(1, 367), fill_value=0)
+    return {"values": values, "time": time.astype(int).tolist(), "date": date.astype(int).tolist()}
+
+# The domains of several years together, the counts of a value are added up
+def merge_domains(domains):
+    values = {}
+    time = [0] * (24 * 60 // TIME_BUCKET_MINUTES)
+    date = [0] * 366
+    for year_domains in domains:
+        for attrib, pairs in year_domains["values"].items():
+            counts = values.setdefault(attrib, {})
+            for value, count in pairs:
+                counts[value] = counts.get(value, 0) + count
+        time = [a + b for a, b in zip(time, year_domains["time"])]
+        date = [a + b for a, b in zip(date, year_domains["date"])]
+    return {"values": {attrib: [[value, count] for value, count in counts.items()] for attrib, counts in values.items()},
+            "time": time, "date": date}
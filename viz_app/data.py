@@ -0,0 +1,467 @@
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from viz_app.cache import LRUCache
+from viz_app.cube import build_cube, build_domains
+from viz_app.bitmap import BitmapIndex
+from config import CUBE_ROLLUPS, DATASET_DIR, STORE_DIR, DATA_CACHE_MAX_BYTES, RAW_COLUMNS, RAW_COLUMN_NAMES, MISSING_VALUE_TABLE, ID_TO_LIGHT_CONDITIONS, ID_TO_JUNCTION_DETAIL, \
+                   ID_TO_JUNCTION_CONTROL, ID_TO_ROAD_SURFACE_CONDITIONS, ID_TO_SPECIAL_CONDITIONS_AT_SITE
+
+
+# Version of the layout of the prepared data. Increase it when prepare_frame changes,
+# so stores that were built by an older version are rebuilt.
+SCHEMA_VERSION = 2
+
+# Prepared data, count cubes and bitmap indexes of recently used years, shared by every callback of this process
+frame_cache = LRUCache(DATA_CACHE_MAX_BYTES)
+
+# Caches with entries that were made from the data of a year, with a function that gives the year and the
+# signature of the data (see source_signature) from the key of an entry. The figure cache is not one of them,
+# its keys are hashes: figures of old data are no longer used either, and are evicted as the cache fills up.
+year_caches = [(frame_cache, lambda key: key[1:3])]
+
+# Signature of the data of every year when this process last read it
+seen_signatures = {}
+
+# A lock that is held by one thread of one process at a time: a thread lock for the threads of this
+# process, and an exclusive lock on a file for the other processes (the server processes and the
+# dataset watcher). Without fcntl (on Windows) only the threads of this process are excluded.
+class FileLock:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        # A forked process gets a new thread lock, like an LRUCache (see viz_app/cache.py)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            # The file is opened every time, a forked process must not share the open file of its parent
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+
+# Only one thread of one process at a time writes the manifest
+manifest_lock = FileLock(os.path.join(STORE_DIR, "manifest.lock"))
+
+# Only one thread of one process at a time (re)builds a store, so a year is not built twice at the same time
+build_lock = FileLock(os.path.join(STORE_DIR, "build.lock"))
+
+# Attributes that are stored as ids in the dataset, with the table to decode them
+ENCODED_ATTRIBS = {
+    'light_conditions': ID_TO_LIGHT_CONDITIONS,
+    'junction_detail': ID_TO_JUNCTION_DETAIL,
+    'junction_control': ID_TO_JUNCTION_CONTROL,
+    'road_surface_conditions': ID_TO_ROAD_SURFACE_CONDITIONS,
+    'special_conditions_at_site': ID_TO_SPECIAL_CONDITIONS_AT_SITE,
+}
+
+# HH:MM label of every minute of the day, the position in the list is the minutes since midnight
+TIME_LABELS = ['{:02d}:{:02d}'.format(m // 60, m % 60) for m in range(24 * 60)]
+
+# MM/DD label of every day of a leap year, the position in the list is the day of the year minus one
+DAY_LABELS = list(pd.date_range('2000-01-01', '2000-12-31').strftime('%m/%d'))
+
+# Smallest integer type that holds every id of the attributes that stay numeric
+DOWNCAST_ATTRIBS = {
+    'speed_limit': 'int8',
+    'region': 'int8',
+    'local_district': 'int16',
+    'accident_severity': 'int8',
+}
+
+# Path of the raw csv file of a year
+def csv_path(year):
+    return os.path.join(DATASET_DIR, "road_safety_" + str(year) + ".csv")
+
+# Path of the prepared columnar (parquet) file of a year
+def store_path(year):
+    return os.path.join(STORE_DIR, "road_safety_" + str(year) + ".parquet")
+
+# Path of a rollup of the count cube of a year, stored next to the prepared data
+def cube_path(year, rollup):
+    return os.path.join(STORE_DIR, "road_safety_" + str(year) + ".cube." + rollup + ".parquet")
+
+# Path of the value domains and histograms of the filters of a year, stored next to the count cube
+def domains_path(year):
+    return os.path.join(STORE_DIR, "road_safety_" + str(year) + ".domains.json")
+
+# Path of the manifest that describes every year in the store
+def manifest_path():
+    return os.path.join(STORE_DIR, "manifest.json")
+
+# Whether a column of a csv file is used by the app, under its own or its raw DfT name
+def is_used_column(column):
+    return column in RAW_COLUMNS or column in RAW_COLUMN_NAMES
+
+# Read a csv file with the dataset, only the columns used by the app are parsed
+def read_csv(path):
+    return pd.read_csv(path, usecols=is_used_column).rename(columns=RAW_COLUMN_NAMES)
+
+# Pre-process the raw data of a year.
+# The number of rows dropped by each missing value rule is added to report, if given.
+def prepare_frame(df, report=None):
+    df_valid = remove_missing_value(df, report)
+    df = id_to_value(df_valid)
+    return add_time_columns(df)
+
+# Read and pre-process the raw csv file of a year
+def prepare_data(year, report=None):
+    return prepare_frame(read_csv(csv_path(year)), report)
+
+# Write a dataframe to a parquet file.
+# The file is written under a temporary name first, so a reader never sees a half written file.
+def write_parquet(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    df.to_parquet(temp_path, engine="pyarrow", index=False)
+    os.replace(temp_path, path)
+
+# Write a value as json, under a temporary name first like write_parquet
+def write_json(value, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+# Write every rollup of the count cube of a year to its own file
+def write_cube(year, cube):
+    for name, rollup in cube.items():
+        write_parquet(rollup, cube_path(year, name))
+
+# Write the prepared data of a year, its count cube and the domains of its filters to the store
+# and return its manifest entry
+def write_store(year, df, dropped):
+    write_parquet(df, store_path(year))
+    cube = build_cube(df)
+    write_cube(year, cube)
+    write_json(build_domains(cube), domains_path(year))
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rows": len(df),
+        "cube_cells": {name: len(rollup) for name, rollup in cube.items()},
+        "dropped": dropped,
+        "memory_bytes": int(df.memory_usage(index=True, deep=True).sum()),
+        "columns": column_stats(df),
+    }
+
+# Build the store of a year from its csv file
+def build_store(year):
+    dropped = {}
+    df = prepare_data(year, dropped)
+    update_manifest({year: write_store(year, df, dropped)})
+    return df
+
+# Type, range and number of distinct values of every column, for the manifest
+def column_stats(df):
+    stats = {}
+    for column in df.columns:
+        values = df[column]
+        stat = {"dtype": str(values.dtype), "missing": int(values.isna().sum())}
+        if values.dtype.name == 'category' or values.dtype == object:
+            stat["distinct"] = int(values.nunique())
+        elif len(values) > 0:
+            stat["min"] = to_json_value(values.min())
+            stat["max"] = to_json_value(values.max())
+        stats[column] = stat
+    return stats
+
+# Convert numpy numbers and timestamps to values that can be written as json
+def to_json_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value.item() if hasattr(value, "item") else value
+
+# Read the manifest of the store, an empty manifest is returned if there is none yet
+def read_manifest():
+    try:
+        with open(manifest_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"schema_version": SCHEMA_VERSION, "years": {}}
+
+# Add or replace the manifest entries of the given years
+def update_manifest(entries):
+    with manifest_lock:
+        manifest = read_manifest()
+        manifest["schema_version"] = SCHEMA_VERSION
+        for year, entry in entries.items():
+            manifest["years"][str(year)] = entry
+        manifest["years"] = dict(sorted(manifest["years"].items()))
+        os.makedirs(STORE_DIR, exist_ok=True)
+        temp_path = "{}.{}.tmp".format(manifest_path(), os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_path, manifest_path())
+
+# The store of a year is usable if it was built by the current version of prepare_frame
+# and it is not older than the csv it was built from
+def store_is_fresh(year):
+    path = store_path(year)
+    if not os.path.exists(path):
+        return False
+    entry = read_manifest()["years"].get(str(year), {})
+    if entry.get("schema_version") != SCHEMA_VERSION:
+        return False
+    source = csv_path(year)
+    return not os.path.exists(source) or os.path.getmtime(path) >= os.path.getmtime(source)
+
+# Modification time and size of the file the data of a year is read from: the store, or the csv
+# if there is no store yet. A rebuilt store replaces the old one in one step, so the signature
+# changes at once for every reader and the cached data of the old store is no longer used.
+# The store may be rebuilt by another process (the dataset watcher), so every process drops the
+# cached data of the old store itself, when it sees the new signature.
+def source_signature(year):
+    path = store_path(year)
+    if not os.path.exists(path):
+        path = csv_path(year)
+    stat = os.stat(path)
+    signature = stat.st_mtime_ns, stat.st_size
+    if seen_signatures.get(year) != signature:
+        seen_signatures[year] = signature
+        drop_stale(year, signature)
+    return signature
+
+# Remove the cached entries of a year that were made from data with another signature
+def drop_stale(year, signature):
+    for cache, year_signature in year_caches:
+        cache.invalidate(lambda key: year_signature(key)[0] == year and year_signature(key)[1] != signature)
+
+# Whether the store of a year has to be (re)built from its csv file before it can be read
+def needs_build(year):
+    return os.path.exists(csv_path(year)) and not store_is_fresh(year)
+
+# Read the prepared data of a year from the store, the store is (re)built from the csv
+# if it is missing or outdated (see viz_app/watcher.py, which rebuilds changed years in
+# the background). Years without a csv file are read from the store as they are
+# (see viz_app/ingest.py).
+def load_data(year):
+    if needs_build(year):
+        with build_lock:
+            # Another thread may have built it while we were waiting
+            if not store_is_fresh(year):
+                return build_store(year)
+    return pd.read_parquet(store_path(year), engine="pyarrow")
+
+# Make the arrays of a dataframe read-only, so a cached frame can be handed out without copying it
+def freeze(df):
+    for block in df._mgr.blocks:
+        values = getattr(block.values, "_ndarray", block.values)
+        if hasattr(values, "flags"):
+            values.flags.writeable = False
+    return df
+
+# Get the prepared data of a year. The result is a read-only view on the cached frame,
+# callers that want to change it have to make their own copy. When only some columns are
+# asked for and the year is not in memory, only those columns are read from the store.
+def get_data(year, columns=None):
+    key = ('data', year, source_signature(year))
+    df = frame_cache.get(key)
+    if df is None and columns is not None and not needs_build(year):
+        return get_columns(year, columns)
+    if df is None:
+        df = freeze(load_data(year))
+        frame_cache.put(key, df, df.memory_usage(index=True, deep=True).sum())
+    if columns is None:
+        return df.copy(deep=False)
+    # Selecting columns gives a new frame that only holds the selected columns
+    return freeze(df[columns])
+
+# Some columns of the prepared data of a year, read from the store and cached by themselves
+def get_columns(year, columns):
+    key = ('columns', year, source_signature(year), tuple(columns))
+    df = frame_cache.get(key)
+    if df is None:
+        df = freeze(pd.read_parquet(store_path(year), engine="pyarrow", columns=list(columns)))
+        frame_cache.put(key, df, df.memory_usage(index=True, deep=True).sum())
+    return df.copy(deep=False)
+
+# The count cube of a year is usable if every rollup is there and not older than a usable store
+def cube_is_fresh(year):
+    paths = [cube_path(year, name) for name in CUBE_ROLLUPS]
+    if not all(os.path.exists(path) for path in paths) or not os.path.exists(store_path(year)):
+        return False
+    if needs_build(year):
+        return False
+    return min(os.path.getmtime(path) for path in paths) >= os.path.getmtime(store_path(year))
+
+# Get the count cube of a year as a dict of rollups (see viz_app/cube.py). The cube is read from
+# the store, or built from the prepared data if it is missing or outdated.
+def get_cube(year):
+    key = ('cube', year, source_signature(year))
+    cube = frame_cache.get(key)
+    if cube is None:
+        if not cube_is_fresh(year):
+            # Loading an outdated year rebuilds its store, which also writes a new cube
+            df = get_data(year)
+            if not cube_is_fresh(year):
+                write_cube(year, build_cube(df))
+        cube = {name: freeze(pd.read_parquet(cube_path(year, name), engine="pyarrow")) for name in CUBE_ROLLUPS}
+        frame_cache.put(key, cube, sum(rollup.memory_usage(index=True, deep=True).sum() for rollup in cube.values()))
+    return {name: rollup.copy(deep=False) for name, rollup in cube.items()}
+
+# The domains of a year are usable if they are not older than a usable count cube
+def domains_are_fresh(year):
+    path = domains_path(year)
+    return os.path.exists(path) and cube_is_fresh(year) and \
+        os.path.getmtime(path) >= max(os.path.getmtime(cube_path(year, name)) for name in CUBE_ROLLUPS)
+
+# Get the values of the filterable attributes of a year with their number of accidents, and the
+# histograms of the time and date filters (see build_domains). They are read from the store, or
+# made from the count cube if they are missing or outdated.
+def get_domains(year):
+    key = ('domains', year, source_signature(year))
+    domains = frame_cache.get(key)
+    if domains is None:
+        if not domains_are_fresh(year):
+            write_json(build_domains(get_cube(year)), domains_path(year))
+        with open(domains_path(year)) as f:
+            text = f.read()
+        domains = json.loads(text)
+        frame_cache.put(key, domains, len(text))
+    return domains
+
+# Get the bitmap index of the prepared data of a year (see viz_app/bitmap.py)
+def get_bitmap_index(year):
+    key = ('bitmap', year, source_signature(year))
+    index = frame_cache.get(key)
+    if index is None:
+        index = BitmapIndex(get_data(year))
+        frame_cache.put(key, index, index.nbytes())
+    return index
+
+# Load the data, count cube and bitmap index of every year into the cache. A server that forks its
+# workers after this (see wsgi.py) shares the loaded years with all workers.
+def preload_years():
+    for year in available_years():
+        get_cube(year)
+        get_domains(year)
+        get_bitmap_index(year)
+
+# Remove rows with missing values for every target attribute.
+# The rules of all attributes are combined in one mask, so the data is only copied once.
+# If a report dict is given, it gets the number of rows dropped by each attribute
+# (a row with several missing values is counted for the first attribute in the table).
+def remove_missing_value(df, report=None):
+    missing = np.zeros(len(df), dtype=bool)
+    for attribute, missing_values in MISSING_VALUE_TABLE.items():
+        if len(missing_values) == 0:
+            continue
+        is_missing = df[attribute].isin(missing_values).to_numpy()
+        if report is not None:
+            report[attribute] = int(np.count_nonzero(is_missing & ~missing))
+        missing |= is_missing
+    # Every row needs a time and a date, add_time_columns has no way to store a missing one
+    for attribute in ['time', 'date']:
+        is_missing = df[attribute].isna().to_numpy()
+        if report is not None:
+            report[attribute] = report.get(attribute, 0) + int(np.count_nonzero(is_missing & ~missing))
+        missing |= is_missing
+    return df[~missing]
+
+# Map IDS to the corresponding value.
+# The decoded attributes are categorical: every row only stores a small integer code and
+# each label is stored once, so filters and group-bys work on the codes. Ids that are not
+# in the table become missing values.
+def id_to_value(df):
+    columns = {}
+    for column in df.columns:
+        if column in ENCODED_ATTRIBS:
+            ids = pd.Index(list(ENCODED_ATTRIBS[column].keys()))
+            columns[column] = pd.Categorical.from_codes(ids.get_indexer(df[column]),
+                                                        categories=list(ENCODED_ATTRIBS[column].values()))
+        elif column in DOWNCAST_ATTRIBS:
+            columns[column] = df[column].to_numpy().astype(DOWNCAST_ATTRIBS[column])
+        else:
+            columns[column] = df[column].to_numpy()
+    # Build a new frame, so the data is only copied once
+    return pd.DataFrame(columns)
+
+# Add typed time and date columns, so requests never have to parse the time and date strings:
+#   time_minutes: minutes since midnight
+#   time_index:   time as HHMM integer (i.e. 13:05 -> 1305)
+#   time:         categorical HH:MM label
+#   date:         parsed date
+#   day_of_year:  day of the year on a leap year calendar (1-366), so a date has the same
+#                 number in every year (i.e. March 1st is always 61)
+#   weekday:      day of the week, monday is 0
+#   month:        month of the year (1-12)
+def add_time_columns(df):
+    # Each distinct time and date is only parsed once
+    time_codes, times = pd.factorize(df['time'])
+    minutes = pd.to_numeric(times.str[0:2]).to_numpy() * 60 + pd.to_numeric(times.str[3:5]).to_numpy()
+    time_minutes = minutes[time_codes]
+    df['time_minutes'] = time_minutes.astype('int16')
+    df['time_index'] = (time_minutes // 60 * 100 + time_minutes % 60).astype('int16')
+    df['time'] = pd.Categorical.from_codes(time_minutes, categories=TIME_LABELS)
+
+    date_codes, dates = pd.factorize(df['date'])
+    dates = pd.to_datetime(dates, dayfirst=True)
+    day_of_year = dates.dayofyear.to_numpy() + (~dates.is_leap_year & (dates.month.to_numpy() > 2))
+    df['date'] = dates.to_numpy()[date_codes]
+    df['day_of_year'] = day_of_year[date_codes].astype('int16')
+    df['weekday'] = dates.weekday.to_numpy()[date_codes].astype('int8')
+    df['month'] = dates.month.to_numpy()[date_codes].astype('int8')
+    return df
+
+# Years for which a csv file or a prepared store file is available
+def available_years():
+    years = set()
+    for directory in [DATASET_DIR, STORE_DIR]:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = re.fullmatch(r"road_safety_(\d+)\.(csv|parquet)", name)
+            if match:
+                years.add(int(match.group(1)))
+    return sorted(years)
+
+# Memory used by the prepared data of a year, with every row holding its label as a
+# string and its ids as int64 (before) and with the compact encoding (after)
+def memory_report(year):
+    df = get_data(year)
+    dtypes = {}
+    for column in ENCODED_ATTRIBS:
+        dtypes[column] = 'object'
+    for column in DOWNCAST_ATTRIBS:
+        dtypes[column] = 'int64'
+    before = df.astype(dtypes).memory_usage(index=True, deep=True).sum()
+    after = df.memory_usage(index=True, deep=True).sum()
+    return {"rows": len(df), "before": int(before), "after": int(after)}
+
+
+if __name__ == '__main__':
+    # Print the memory report of every available year
+    print("{:>6} {:>10} {:>12} {:>12} {:>7}".format("year", "rows", "before (MB)", "after (MB)", "ratio"))
+    for year in available_years():
+        report = memory_report(year)
+        print("{:>6} {:>10} {:>12.1f} {:>12.1f} {:>6.1f}x".format(
+            year, report["rows"], report["before"] / 1024 ** 2, report["after"] / 1024 ** 2,
+            report["before"] / report["after"]))
@@ -0,0 +1,65 @@
+import hashlib
+import json
+
+import flask
+from plotly.io.json import to_json_plotly
+
+from viz_app.cache import LRUCache
+from config import FIGURE_CACHE_MAX_BYTES, COMPRESSED_CACHE_MAX_BYTES
+
+
+# The children (with the figures) of recently made views as JSON, keyed by a hash of the inputs of the view.
+# The same view is only made once for every user, until the data it was made from changes.
+figure_cache = LRUCache(FIGURE_CACHE_MAX_BYTES)
+
+
+# A hash of the name and the inputs of a view. The inputs have to include the version of the
+# data of the view (see counts_version), so a view is made again when its data changes.
+def figure_key(view, *inputs):
+    text = json.dumps([view] + list(inputs), sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+# The children of a view that was made before, or None
+def get_figures(key):
+    text = figure_cache.get(key)
+    if text is None:
+        return None
+    mark_response(key)
+    return json.loads(text)
+
+def put_figures(key, children):
+    # Plotly serializes with orjson when it is installed, which is much faster for large figures
+    text = to_json_plotly(children)
+    figure_cache.put(key, text, len(text))
+    mark_response(key)
+
+# The response of a callback that returns a cached view only depends on the key of the view, so
+# its compressed body can be cached as well. The key is kept for the response of the current request.
+def mark_response(key):
+    if flask.has_request_context():
+        flask.g.figure_key = key
+
+
+# The compressed bodies of the responses that return a cached view, used as the cache backend of
+# Flask-Compress (see viz_app/main.py). Other responses have no key and are compressed every time.
+class CompressedResponses(LRUCache):
+
+    def get(self, key):
+        if key is None:
+            return None
+        return super().get(key)
+
+    def set(self, key, value):
+        if key is not None:
+            self.put(key, value, len(value))
+
+
+compressed_cache = CompressedResponses(COMPRESSED_CACHE_MAX_BYTES)
+
+
+# The key of the compressed body of a response, the body differs per compression algorithm
+def compressed_key(request):
+    key = flask.g.get("figure_key")
+    if key is None:
+        return None
+    return (key, request.path, request.headers.get("Accept-Encoding", ""))
@@ -0,0 +1,83 @@
+import os
+import shutil
+import argparse
+import tempfile
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from viz_app.data import is_used_column, read_csv, csv_path, prepare_frame, write_store, update_manifest, \
+                         available_years
+from config import STORE_DIR, RAW_COLUMN_NAMES, CPU_COUNT
+
+# Builds the dataset store from the raw DfT accident files, i.e.
+#   python -m viz_app.ingest dft-road-casualty-statistics-accident-1979-2020.csv
+# Without files, the store is built from the datasets/road_safety_<year>.csv files.
+
+# Number of rows of a raw file that are read at once
+CHUNK_ROWS = 500000
+
+
+# Split the raw files into parquet parts per year, so every year can be prepared by its own
+# process without holding the whole dataset in memory
+def split_by_year(paths, staging_dir, years=None):
+    part = 0
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=is_used_column, chunksize=CHUNK_ROWS, low_memory=False):
+            chunk = chunk.rename(columns=RAW_COLUMN_NAMES)
+            for year, df_year in chunk.groupby('accident_year'):
+                if years and year not in years:
+                    continue
+                year_dir = os.path.join(staging_dir, str(year))
+                os.makedirs(year_dir, exist_ok=True)
+                df_year.to_parquet(os.path.join(year_dir, "part-{}.parquet".format(part)), index=False)
+                part += 1
+    return sorted(int(year) for year in os.listdir(staging_dir))
+
+# Prepare a year from its staged parts (or from its csv file) and write it to the store.
+# This runs in a worker process.
+def ingest_year(year, year_dir=None):
+    if year_dir is None:
+        df = read_csv(csv_path(year))
+    else:
+        # Read the parts one by one, their types can differ per chunk (i.e. int and float)
+        df = pd.concat([pd.read_parquet(os.path.join(year_dir, name)) for name in sorted(os.listdir(year_dir))],
+                       ignore_index=True)
+    dropped = {}
+    df = prepare_frame(df, dropped)
+    return year, write_store(year, df, dropped)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m viz_app.ingest",
+                                     description="Build the dataset store from the raw DfT accident files.")
+    parser.add_argument("files", nargs="*",
+                        help="raw accident csv files, by default the datasets/road_safety_<year>.csv files are used")
+    parser.add_argument("--years", type=int, nargs="+", help="only build these years")
+    parser.add_argument("--workers", type=int, default=CPU_COUNT, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    staging_dir = None
+    try:
+        if args.files:
+            staging_dir = tempfile.mkdtemp(prefix="staging-", dir=STORE_DIR)
+            years = split_by_year(args.files, staging_dir, args.years)
+        else:
+            years = [year for year in available_years()
+                     if os.path.exists(csv_path(year)) and (not args.years or year in args.years)]
+
+        entries = {}
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(ingest_year, year, staging_dir and os.path.join(staging_dir, str(year)))
+                       for year in years]
+            for future in as_completed(futures):
+                year, entry = future.result()
+                entries[year] = entry
+                print("{}: {} rows, {} dropped".format(year, entry["rows"], sum(entry["dropped"].values())))
+        update_manifest(entries)
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import os
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from threadpoolctl import threadpool_limits
+
+from config import JOB_WORKERS, JOB_THREADS, JOB_RESULT_TTL_SECONDS, JOB_DIR
+
+
+# Runs in every job worker when it starts. The threads of the BLAS and OpenMP libraries that
+# scikit-learn uses are limited, so the workers together do not use more threads than there are cores.
+def init_job_worker(threads):
+    threadpool_limits(limits=threads)
+
+# Write a value to a file of a job in one step, so a reader never sees half of it
+def write_job_file(path, value=None):
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, "wb") as f:
+        pickle.dump(value, f)
+    os.replace(temp_path, path)
+
+# Runs a job in a job worker. The state of the job is kept in files next to the job (<path>.running,
+# then <path>.done with the result or <path>.failed with the exception), so every server process
+# can answer the polls of the browser. A job that was cancelled before it started does not run.
+def run_job(path, fn, args):
+    if os.path.exists(path + ".cancelled"):
+        return
+    write_job_file(path + ".running")
+    try:
+        result = fn(*args)
+    except Exception as e:
+        try:
+            write_job_file(path + ".failed", e)
+        except Exception:
+            # The exception can't be pickled, keep its message
+            write_job_file(path + ".failed", RuntimeError(repr(e)))
+        return
+    write_job_file(path + ".done", result)
+
+# Queue of long running computations. The jobs run in worker processes, so a callback only submits
+# a job and returns, and the browser polls (with a dcc.Interval) until the result of the job is ready.
+# The state and the result of a job are kept in the job directory, so a poll may reach any server process.
+class JobQueue:
+
+    def __init__(self, workers, threads, ttl, directory=JOB_DIR):
+        self.workers = workers
+        self.threads = threads
+        # Results that are not picked up within ttl seconds are removed
+        self.ttl = ttl
+        self.directory = directory
+        # Job id -> future, of the jobs submitted by this process
+        self.futures = {}
+        self.executor = None
+        # Dash serves callbacks from multiple threads
+        self.lock = threading.Lock()
+
+    # Share the job workers and their threads with the other server processes, every server process
+    # has its own workers. Together they don't start more than JOB_WORKERS workers (at least one per
+    # server process) or more threads than the workers of a single process would.
+    def split(self, servers):
+        threads = self.workers * self.threads
+        self.workers = max(1, self.workers // servers)
+        self.threads = max(1, threads // (servers * self.workers))
+
+    def path(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_job_worker, initargs=(self.threads,))
+
+    # Start the workers now, before this process serves requests (see start_aggregate_pool in viz_app/query.py)
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = self.new_executor()
+            executor = self.executor
+        # The workers are forked when the first task is submitted
+        executor.submit(int).result()
+
+    # Run fn(*args) in a worker process and return the id of the job
+    def submit(self, fn, *args):
+        with self.lock:
+            self.expire()
+            # The workers are started on first use, if they were not started before
+            if self.executor is None:
+                self.executor = self.new_executor()
+            job_id = uuid.uuid4().hex
+            os.makedirs(self.directory, exist_ok=True)
+            write_job_file(self.path(job_id) + ".job")
+            try:
+                future = self.executor.submit(run_job, self.path(job_id), fn, args)
+            except BrokenProcessPool:
+                # A worker died (e.g. it ran out of memory), its jobs failed. New workers run this job.
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.new_executor()
+                future = self.executor.submit(run_job, self.path(job_id), fn, args)
+            self.futures[job_id] = future
+        future.add_done_callback(lambda future: self.finished(job_id, future))
+        return job_id
+
+    # A job of this process stopped. If run_job itself failed (e.g. the worker died), the job is
+    # marked as failed, since it did not write its state.
+    def finished(self, job_id, future):
+        with self.lock:
+            self.futures.pop(job_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            write_job_file(self.path(job_id) + ".failed", future.exception())
+
+    # "pending", "running", "done" or "failed", or None if there is no such job (anymore)
+    def status(self, job_id):
+        path = self.path(job_id)
+        if os.path.exists(path + ".cancelled"):
+            return None
+        for status in ["done", "failed", "running"]:
+            if os.path.exists(path + "." + status):
+                return status
+        return "pending" if os.path.exists(path + ".job") else None
+
+    # Number of seconds since the job was submitted
+    def elapsed(self, job_id):
+        try:
+            return time.time() - os.path.getmtime(self.path(job_id) + ".job")
+        except OSError:
+            return 0
+
+    # The result of a finished job, which is removed from the queue.
+    # Raises the exception of the job if it failed.
+    def pop_result(self, job_id):
+        path = self.path(job_id)
+        if os.path.exists(path + ".done"):
+            with open(path + ".done", "rb") as f:
+                result = pickle.load(f)
+            self.remove(job_id)
+            return result
+        with open(path + ".failed", "rb") as f:
+            exception = pickle.load(f)
+        self.remove(job_id)
+        raise exception
+
+    # The result of a job is no longer needed. A job that did not start yet does not run at all,
+    # a job that is running finishes in its worker but its result is dropped.
+    def cancel(self, job_id):
+        with self.lock:
+            future = self.futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        if os.path.exists(self.path(job_id) + ".job"):
+            # The job may have been submitted by another server process
+            write_job_file(self.path(job_id) + ".cancelled")
+
+    # Remove the files of a job
+    def remove(self, job_id):
+        for name in os.listdir(self.directory):
+            if name.split(".")[0] == job_id:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # Removed by another server process
+                    pass
+
+    # Remove the files of jobs that finished or were cancelled, and that did not change for ttl seconds
+    def expire(self):
+        if not os.path.isdir(self.directory):
+            return
+        jobs = {}
+        for name in os.listdir(self.directory):
+            try:
+                changed = os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            job_id, _, status = name.partition(".")
+            ended, last_change = jobs.get(job_id, (False, 0))
+            jobs[job_id] = (ended or status in ["done", "failed", "cancelled"], max(last_change, changed))
+        now = time.time()
+        for job_id, (ended, last_change) in jobs.items():
+            if ended and now - last_change > self.ttl:
+                self.remove(job_id)
+
+
+jobs = JobQueue(JOB_WORKERS, JOB_THREADS, JOB_RESULT_TTL_SECONDS)
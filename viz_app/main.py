@@ -1,3 +1,17 @@
 import dash
+from flask_compress import Compress
 
-app = dash.Dash(__name__, suppress_callback_exceptions=True)
\ No newline at end of file
+from viz_app.figures import compressed_cache, compressed_key
+from config import COMPRESS_ALGORITHM, COMPRESS_BR_LEVEL
+
+app = dash.Dash(__name__, suppress_callback_exceptions=True)
+
+# Compress the responses (figures are mostly numbers and compress well). Dash only enables gzip,
+# so Flask-Compress is set up here, with the compressed responses of cached figures kept.
+app.server.config.update(
+    COMPRESS_ALGORITHM=COMPRESS_ALGORITHM,
+    COMPRESS_BR_LEVEL=COMPRESS_BR_LEVEL,
+    COMPRESS_CACHE_BACKEND=lambda: compressed_cache,
+    COMPRESS_CACHE_KEY=compressed_key,
+)
+Compress(app.server)
\ No newline at end of file
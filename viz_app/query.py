@@ -0,0 +1,275 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from viz_app.cache import LRUCache
+from viz_app.data import get_data, get_cube, get_domains, get_bitmap_index, source_signature, available_years, \
+                          read_manifest, frame_cache, year_caches
+from viz_app.cube import cube_rollup, query_cube, merge_domains
+from config import FILTER_CACHE_MAX_BYTES, AGGREGATE_WORKERS, AGGREGATE_MAX_BYTES, ALL_YEARS
+
+
+# Smallest and largest value of the attributes that are filtered on a range
+RANGE_BOUNDS = {
+    "time": (0, 2359),
+    "date": (1, 366),
+}
+
+# Rows selected by recently used filters, as packed bitsets, keyed by year and canonical filter
+filter_cache = LRUCache(FILTER_CACHE_MAX_BYTES)
+year_caches.append((filter_cache, lambda key: key[0:2]))
+
+# Worker processes that count the accidents of the years of a year span, started on first use.
+# Every worker keeps its own caches, so a year that was counted before is not loaded again.
+aggregate_pool = None
+aggregate_pool_lock = threading.Lock()
+
+# Number of worker processes and memory of this server process for counting years, see split_aggregate_budget
+aggregate_workers = AGGREGATE_WORKERS
+aggregate_max_bytes = AGGREGATE_MAX_BYTES
+
+
+# A filter_dict in a canonical form that can be used as a cache key. Attributes without a filter
+# are left out and attributes and values are sorted. Time and date ranges of stacked range filters
+# are intersected and a range that covers the whole day or year is left out, since it matches
+# every accident.
+def canonical_filter(filter_dict):
+    items = []
+    for attrib in sorted(filter_dict):
+        filter_options = filter_dict[attrib]
+        # Skip if this attribute has no filter yet
+        if len(filter_options) == 0:
+            continue
+        if attrib in RANGE_BOUNDS:
+            low, high = RANGE_BOUNDS[attrib]
+            start = max([low] + [int(x) for x in filter_options[0::2]])
+            end = min([high] + [int(x) for x in filter_options[1::2]])
+            if start == low and end == high:
+                continue
+            items.append((attrib, (start, end)))
+        else:
+            items.append((attrib, tuple(sorted(set(filter_options)))))
+    return tuple(items)
+
+# The rows of a year that match filter_dict, or None if nothing is filtered: a boolean mask, or the
+# row numbers when a time or date range is filtered (see BitmapIndex.select). Both can index the
+# columns of the year. The selection is computed from the bitmap index of the year and kept in the filter cache.
+def filter_mask(year, filter_dict):
+    canonical = canonical_filter(filter_dict)
+    if len(canonical) == 0:
+        return None
+    key = (year, source_signature(year), canonical)
+    selection = filter_cache.get(key)
+    if selection is None:
+        selection = get_bitmap_index(year).select(dict(canonical))
+        filter_cache.put(key, selection, selection.nbytes)
+    if selection.dtype != np.uint8:
+        return selection
+    return np.unpackbits(selection, count=get_bitmap_index(year).rows).view(bool)
+
+# Codes (0, 1, ...) of the rows of a categorical or integer column that are selected by mask, a boolean
+# mask or row numbers (every row if mask is None), and the values the codes stand for. Missing values get code -1.
+def column_codes(column, mask=None):
+    if column.dtype.name == 'category':
+        codes = column.cat.codes.to_numpy()
+        return (codes if mask is None else codes[mask]), column.cat.categories
+    values = column.to_numpy()
+    if mask is not None:
+        values = values[mask]
+    if len(values) == 0:
+        return values.astype(np.int64), pd.Index([], dtype=values.dtype)
+    low = values.min()
+    return values.astype(np.int64) - low, pd.Index(np.arange(low, values.max() + 1, dtype=values.dtype))
+
+# Count the accidents and fatal accidents grouped by the given columns, for the rows of df that are
+# selected by mask (a boolean mask or row numbers, every row if mask is None). Groups are counted with np.bincount on one combined
+# code per row, so the selected rows are never copied into a new dataframe: besides the mask, only
+# the codes of the selected rows are materialized.
+def count_selection(df, group_by, mask=None):
+    is_fatal = df['accident_severity'].to_numpy() == 1
+    if mask is not None:
+        is_fatal = is_fatal[mask]
+    key = np.zeros(len(is_fatal), dtype=np.int64)
+    valid = np.ones(len(is_fatal), dtype=bool)
+    levels = []
+    for column in group_by:
+        codes, level = column_codes(df[column], mask)
+        valid &= codes >= 0
+        key = key * len(level) + codes
+        levels.append(level)
+    # Rows with a missing value are not counted
+    key = key[valid]
+    size = int(np.prod([len(level) for level in levels]))
+    accident_count = np.bincount(key, minlength=size)
+    fatal_count = np.bincount(key, weights=is_fatal[valid], minlength=size).astype(np.int64)
+
+    # Only keep the groups that have accidents, in the order of the codes
+    groups = np.flatnonzero(accident_count)
+    # Without group_by there is one group, numpy can't unravel indices of a 0d array
+    group_codes = np.unravel_index(groups, [len(l) for l in levels]) if group_by else []
+    result = {}
+    for column, codes, level in zip(group_by, group_codes, levels):
+        if df[column].dtype.name == 'category':
+            result[column] = pd.Categorical.from_codes(codes, categories=level)
+        else:
+            result[column] = level.to_numpy()[codes]
+    result['accident_count'] = accident_count[groups]
+    result['fatal_count'] = fatal_count[groups]
+    return pd.DataFrame(result)
+
+# Count the accidents and fatal accidents (accident_count, fatal_count) of a year grouped by the
+# given attributes, for the accidents that match filter_dict. A rollup of the count cube of the year
+# is used when one has every attribute, only otherwise the rows are counted with the mask of the filter.
+def count_accidents(year, group_by, filter_dict):
+    filter_dict = dict(canonical_filter(filter_dict))
+    rollup = cube_rollup(group_by, filter_dict)
+    if rollup is not None:
+        return query_cube(get_cube(year)[rollup], group_by, filter_dict)
+    mask = filter_mask(year, filter_dict)
+    # Without a filter only the counted columns are needed, the whole year is read for the bitmap index
+    return count_selection(get_data(year, group_by + ['accident_severity']), group_by, mask)
+
+# Count the accidents of one year like count_accidents, the group_by may contain accident_year
+def count_year(year, group_by, filter_dict):
+    counts = count_accidents(year, [a for a in group_by if a != 'accident_year'], filter_dict)
+    if 'accident_year' in group_by:
+        counts.insert(group_by.index('accident_year'), 'accident_year', year)
+    return counts
+
+# Runs in every worker process when it starts, the prepared years and the filter selections it
+# keeps in memory are limited to its share of the memory budget. The caches of the server process
+# (e.g. the preloaded years, see wsgi.py) are kept as shared entries, since the worker is forked
+# from the server process and shares their memory.
+def init_aggregate_worker(max_bytes, filter_bytes):
+    frame_cache.share()
+    filter_cache.share()
+    frame_cache.max_bytes = max_bytes
+    filter_cache.max_bytes = filter_bytes
+
+# Share the aggregate workers and memory with the other server processes, every server process
+# has its own worker processes. With a single worker per server process, the years are counted
+# in the server process itself.
+def split_aggregate_budget(servers):
+    global aggregate_workers, aggregate_max_bytes
+    aggregate_workers = max(1, AGGREGATE_WORKERS // servers)
+    aggregate_max_bytes = AGGREGATE_MAX_BYTES // servers
+
+# The number of processes that count years (at most the given number) and the memory every process
+# may keep for prepared years and for filter selections. Besides its caches, a process holds the year
+# it is counting, which takes about twice the memory of the prepared data with its index, so the
+# largest year limits the number of processes. Both caches are part of the share of a process.
+def aggregate_budget(workers):
+    years = read_manifest()["years"].values()
+    largest = max([2 * entry.get("memory_bytes", 0) for entry in years] + [1])
+    workers = max(1, min(workers, aggregate_max_bytes // largest))
+    rest = max(0, aggregate_max_bytes // workers - largest)
+    # The filter selections get at most a quarter of what is left, the prepared years the remainder
+    filter_bytes = min(FILTER_CACHE_MAX_BYTES, rest // 4)
+    return workers, rest - filter_bytes, filter_bytes
+
+def get_aggregate_pool():
+    global aggregate_pool
+    with aggregate_pool_lock:
+        if aggregate_pool is None:
+            workers, max_bytes, filter_bytes = aggregate_budget(aggregate_workers)
+            aggregate_pool = ProcessPoolExecutor(max_workers=workers, initializer=init_aggregate_worker,
+                                                 initargs=(max_bytes, filter_bytes))
+        return aggregate_pool
+
+# Start the worker processes now, if this process counts years with a pool. A process that forks
+# while another thread holds a lock gets a copy of that lock that is never released, so the server
+# processes start their workers before they serve requests (see gunicorn.conf.py).
+def start_aggregate_pool():
+    if aggregate_workers > 1:
+        # The workers are forked when the first task is submitted
+        get_aggregate_pool().submit(int).result()
+
+# Stop using a pool that broke, the next call of get_aggregate_pool starts a new one
+def reset_aggregate_pool(pool):
+    global aggregate_pool
+    with aggregate_pool_lock:
+        if aggregate_pool is pool:
+            aggregate_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Count the years with the worker processes. A worker that died (e.g. it was killed when the machine
+# ran out of memory) breaks the pool: the pool is then replaced and the years that were not counted yet
+# are tried once more. If the new pool breaks as well, they are counted in this process.
+def count_years_in_pool(years, group_by, filter_dict):
+    done = 0
+    for attempt in range(2):
+        pool = get_aggregate_pool()
+        try:
+            for part in pool.map(count_year, years[done:], repeat(group_by), repeat(filter_dict)):
+                done += 1
+                yield part
+            return
+        except BrokenProcessPool:
+            reset_aggregate_pool(pool)
+    yield from count_years_in_process(years[done:], group_by, filter_dict)
+
+# Count the years one after the other in this process. The caches of this process are kept within
+# the share of a single worker process (see aggregate_budget) while the years are counted, so the
+# years loaded for a year span don't take more memory than they would in a worker.
+def count_years_in_process(years, group_by, filter_dict):
+    _, max_bytes, filter_bytes = aggregate_budget(1)
+    for year in years:
+        yield count_year(year, group_by, filter_dict)
+        frame_cache.trim(max_bytes)
+        filter_cache.trim(filter_bytes)
+
+# Add the counts of two sets of groups
+def add_counts(counts, other, group_by):
+    counts = pd.concat([counts, other], ignore_index=True)
+    if len(group_by) == 0:
+        return counts[['accident_count', 'fatal_count']].sum().to_frame().T
+    counts = counts.groupby(group_by, observed=True)[['accident_count', 'fatal_count']].sum()
+    return counts.reset_index().sort_values(group_by, ignore_index=True)
+
+# The years of a dataset-year value, which is a year or ALL_YEARS
+def dataset_years(year):
+    if year == ALL_YEARS:
+        return available_years()
+    return [year]
+
+# The years that have data, sorted and without duplicates
+def existing_years(years):
+    available = set(available_years())
+    return [year for year in sorted(set(years)) if year in available]
+
+# Version of the counts of aggregate_years: the years, the attributes, the canonical filter and the
+# signatures of the data of the years. Counts with the same version are the same.
+def counts_version(years, group_by, filter_dict):
+    years = existing_years(years)
+    return [years, group_by, canonical_filter(filter_dict), [source_signature(year) for year in years]]
+
+# The values and histograms of the filters (see build_domains) of several years together
+def dataset_domains(years):
+    return merge_domains([get_domains(year) for year in existing_years(years)])
+
+# Count the accidents and fatal accidents (accident_count, fatal_count) of several years grouped by
+# the given attributes, for the accidents that match filter_dict. Add accident_year to group_by to
+# count every year separately. The years are counted in parallel by the worker processes and the
+# counts are added up as the years come in, so there is never more than one year per worker in
+# memory, also when all years are counted. Years of which there is no data are skipped.
+# With an empty group_by only the total number of accidents is counted.
+def aggregate_years(years, group_by, filter_dict):
+    years = existing_years(years)
+    if len(years) <= 1:
+        parts = (count_year(year, group_by, filter_dict) for year in years)
+    elif aggregate_workers <= 1:
+        parts = count_years_in_process(years, group_by, filter_dict)
+    else:
+        parts = count_years_in_pool(years, group_by, filter_dict)
+    counts = pd.DataFrame(columns=group_by + ['accident_count', 'fatal_count'])
+    for i, part in enumerate(parts):
+        if i == 0 or 'accident_year' in group_by:
+            # The groups of different years never overlap
+            counts = part if i == 0 else pd.concat([counts, part], ignore_index=True)
+        else:
+            counts = add_counts(counts, part, group_by)
+    return counts
@@ -5,11 +5,15 @@ from dash import html
 from dash import dcc
 import datetime
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.colors import make_colorscale
+import numpy as np
 import pandas as pd
 from sklearn.cluster import KMeans
-from dash.dependencies import Input, Output, MATCH, ALL
+from dash.dependencies import Input, Output, State, MATCH, ALL, ClientsideFunction
 
 from viz_app.main import app
+from viz_app.data import TIME_LABELS
 from config import CATEGORICAL_ATTRIBS, QUANTITATIVE_ATTRIBS, DISCRETE_COL, SEQ_CONT_COL, \
 SORT_ORDER_OPTIONS, LIGHT_CONDITIONS, SPECIAL_CONDITIONS_AT_SITE, ROAD_SURFACE_CONDITIONS, \
 JUNCTION_CONTROL, JUNCTION_DETAIL
@@ -47,6 +51,19 @@ def make_correlations_panel():
                             searchable=False,
                         ),
                     ]),
+                    # More categorical attributes for the parallel categories diagram
+                    html.Div([
+                        html.Label("More Dimensions"),
+                        dcc.Dropdown(
+                            id={
+                                'type': "correlations-attrib-more",
+                                'index': 0,
+                            },
+                            options=[{'label': generate_dropdown_label(a), 'value': a} for a in CATEGORICAL_ATTRIBS],
+                            multi=True,
+                            value=[],
+                        ),
+                    ]),
                     # A dropdown that allows the user to choose another sequential continuous color palette. 
                     # Sequential and Continuous color palettes only, because the fatality rate is 
                     # sequentially ordered. The color palettes are built-in from Plotly, see
@@ -133,60 +150,85 @@ def show_hide_homepage(attrib):
 
     return [{'label': generate_dropdown_label(a), 'value': a} for a in possible_attribs], None 
 
-def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_disc, corr_sort_order, k_means, n_clusters):
+# The attributes the accidents are counted by for the correlations view. The parallel categories
+# diagram of two categorical attributes gets the additional dimensions as well.
+def correlations_group_by(attrib1, attrib2, more_attribs=None):
+    # No plotting when an attribute is missing
+    if attrib1 is None or attrib2 is None:
+        return []
+    # Time is counted per minute passed
+    if attrib1 == 'time':
+        return ['time_minutes']
+    if attrib2 in CATEGORICAL_ATTRIBS:
+        group_by = [attrib1]
+        for a in [attrib2] + list(more_attribs or []):
+            if a not in group_by:
+                group_by.append(a)
+        return group_by
+    return [attrib1]
+
+# Whether the correlations graphs of two attributes can be brushed, only the scatter plot
+# and histogram of a categorical and a quantitative attribute can
+def has_brushing(attrib1, attrib2):
+    return (attrib1 in QUANTITATIVE_ATTRIBS) != (attrib2 in QUANTITATIVE_ATTRIBS)
+
+# Whether making the correlations graphs takes long, so they are made by a background job
+# (see viz_app/jobs.py): only K-Means clustering does
+def is_heavy(attrib1, attrib2, k_means):
+    return attrib1 in QUANTITATIVE_ATTRIBS and attrib2 in QUANTITATIVE_ATTRIBS and 'k_means' in k_means
+
+# The fatality rate per value of attrib1, which the scatter plot and histogram are made from
+# and which brushing makes them again from
+def brushing_dataframe(df_counts, attrib1):
+    return calculate_fatality_rate(df_counts, attrib1).reset_index()
+
+# Make the children (the graphs) of the correlations view from the number of (fatal) accidents
+# (accident_count, fatal_count) grouped by the attributes of correlations_group_by
+def make_correlations_graphs(df_counts, attrib1, attrib2, corr_color_seq, corr_color_disc, corr_sort_order, k_means, n_clusters):
     # You can use:
     # (attrib1 in categorical_attribs) and
     # (attrib1 in quantitive_attribs)
 
     # No plotting when an attribute is missing
     if (isinstance(attrib1, type(None)) or isinstance(attrib2, type(None))):
-        return False
+        return []
 
-    df_temp = df.copy()
     # To check the type of attribute.
     if (attrib1 in CATEGORICAL_ATTRIBS and attrib2 in CATEGORICAL_ATTRIBS):
-        attributes_to_group = []
-
-        # if chosen attributes are the same, show only one
-        if attrib1 == attrib2:
-            attributes_to_group.append(attrib1)
-        else:
-            attributes_to_group.append(attrib1)
-            attributes_to_group.append(attrib2)
-        # Compute fatality rate of each combination of the two chosen attributes
-        df_fatality = (
-                    df_temp[df_temp['accident_severity'] == 1].groupby(attributes_to_group).count() / df_temp.groupby(
-                attributes_to_group).count()).rename(columns={'accident_severity': 'fatality'})
-        # Join df_temp and df_fatality on the chosen features
-        final_df = pd.merge(df_temp, df_fatality, on=attributes_to_group)
-
-        # Create parallel categories diagram
-        # Add third attribute: fatality rate as color
-        fig = px.parallel_categories(final_df, dimensions=attributes_to_group, color='fatality',
-                                     color_continuous_scale=corr_color_seq, height=800, labels={attributes_to_group[0]:
-                                     attributes_to_group[0].replace("_", " ").title(), attributes_to_group[1]:
-                                     attributes_to_group[1].replace("_", " ").title(), 'fatality': 'Fatality Rate(%)'})
+        # The dimensions are the attributes the accidents are counted by: the two chosen
+        # attributes (only one if they are the same) and the additional dimensions
+        dimensions = [c for c in df_counts.columns if c not in ['accident_count', 'fatal_count']]
+        # Compute fatality rate of each combination of the chosen attributes
+        df_fatality = df_counts.copy()
+        df_fatality['fatality'] = df_fatality['fatal_count'] / df_fatality['accident_count']
+
+        # Create parallel categories diagram with one path per combination, weighted by its number of accidents
+        # Add another attribute: fatality rate as color
+        fig = go.Figure(go.Parcats(
+            dimensions=[{'label': a.replace("_", " ").title(), 'values': df_fatality[a]} for a in dimensions],
+            counts=df_fatality['accident_count'],
+            line={'color': df_fatality['fatality'], 'coloraxis': 'coloraxis'},
+        ))
         fig.update_layout(
+            height=800,
             margin=dict(l=270, r=250, t=20, b=20),
+            coloraxis={'colorscale': make_colorscale(corr_color_seq),
+                       'colorbar': {'title': {'text': 'Fatality Rate(%)'}, 'x': 1.30}},
         )
-        fig.layout['coloraxis']['colorbar']['x'] = 1.30
-
-        return {
-            "children" : [
-                html.H5("Parallel Categories Diagram"),
-                dcc.Graph(
-                    id={
-                        'type': "correlations-graph",
-                        'index': 0,
-                    }, 
-                    figure=fig
-                )
-            ],
-            "dataframe" : final_df
-        }
-
-    if (attrib1 in QUANTITATIVE_ATTRIBS) != (attrib2 in QUANTITATIVE_ATTRIBS):
-        df_fatal = calculate_fatality_rate(df_temp, attrib1).reset_index()
+
+        return [
+            html.H5("Parallel Categories Diagram"),
+            dcc.Graph(
+                id={
+                    'type': "correlations-graph",
+                    'index': 0,
+                }, 
+                figure=fig
+            )
+        ]
+
+    if has_brushing(attrib1, attrib2):
+        df_fatal = brushing_dataframe(df_counts, attrib1)
         # depending on the combination of the attributes, filters are applied
         # Only attrib1 is considered, since this one is the only categorical attribute
 
@@ -200,7 +242,7 @@ def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_di
 
         # Create the Histogram
         fig2 = px.histogram(df_fatal.reset_index(), x=attrib1, y=attrib2, height=800, color=attrib1,
-                    color_discrete_sequence=corr_color_disc,nbins=df[attrib1].unique().size,
+                    color_discrete_sequence=corr_color_disc,nbins=df_counts[attrib1].unique().size,
                     labels={attrib1: attrib1.replace("_", " ").title(),
                     attrib2: attrib2.replace("_", " ").title()})
         # Configures sorting order type
@@ -208,30 +250,35 @@ def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_di
 
         fig2.update_traces(marker=dict(size=10), selector=dict(mode='markers'))
 
-        return {
-            "children" : [
-                html.H5("Scatter Plot and Histogram"),
-                html.H6("{}(x) vs {}(y)".format(attrib1.replace("_", " ").title(), attrib2.replace("_", " ").title())),
-                dcc.Graph(
-                    id={
-                        'type': "correlations-graph",
-                        'index': 0,
-                    }, 
-                    figure=fig
-                ),
-                dcc.Graph(
-                    id={
-                        'type': "correlations-graph",
-                        'index': 1,
-                    }, 
-                    figure=fig2
-                )
-            ],
-            "dataframe" : df_fatal
-        }
+        # Selecting points in one graph highlights them in the other graph (see brush in assets/clientside.js)
+        for figure in [fig, fig2]:
+            figure.update_layout(dragmode='select', xaxis_zeroline=False, yaxis_zeroline=False)
+            figure.update_xaxes(fixedrange=True)
+            figure.update_yaxes(fixedrange=True)
+            figure.update_traces(selected=dict(marker=dict(opacity=1.0)), unselected=dict(marker=dict(opacity=0.2)))
+
+        return [
+            html.H5("Scatter Plot and Histogram"),
+            html.H6("{}(x) vs {}(y)".format(attrib1.replace("_", " ").title(), attrib2.replace("_", " ").title())),
+            dcc.Graph(
+                id={
+                    'type': "correlations-graph",
+                    'index': 0,
+                }, 
+                figure=fig
+            ),
+            dcc.Graph(
+                id={
+                    'type': "correlations-graph",
+                    'index': 1,
+                }, 
+                figure=fig2
+            )
+        ]
 
     if (attrib1 in QUANTITATIVE_ATTRIBS and attrib2 in QUANTITATIVE_ATTRIBS):
-        df_fatal = calculate_fatality_rate(df_temp, attrib1)
+        # Group on the minutes since midnight that were computed when the data was loaded
+        df_fatal = calculate_fatality_rate(df_counts, 'time_minutes')
         df_to_use = df_fatal
         color = "fatality_rate"
         colormap=corr_color_seq
@@ -241,11 +288,9 @@ def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_di
             # Use a discrete colormap for the coloring of different clusters.
             colormap=corr_color_disc
 
-            df_kmeans = df_to_use[[attrib2]].reset_index().copy()
+            # The time is already numerical (minutes passed)
+            df_kmeans = df_to_use[[attrib2]].reset_index()
 
-            # We need time to be numerical, so we convert from HH:MM -> minutes passed
-            df_kmeans['time'] = [int(x[0:2])*60 + int(x[3:5]) for x in df_kmeans['time']]
-            
             kmeans = KMeans(n_clusters=n_clusters).fit(df_kmeans)
 
             color = kmeans.labels_
@@ -258,6 +303,9 @@ def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_di
                                     color_discrete_sequence=corr_color_disc)
             fig2.update_traces(marker=dict(size=20, symbol='x', opacity=1.0), selector=dict(mode='markers'))
 
+        # Convert the minutes back to HH:MM so we can plot it
+        df_fatal.index = pd.Index(np.take(TIME_LABELS, df_fatal.index), name=attrib1)
+
         # Create new plot
         fig = px.scatter(df_fatal.reset_index(), x=attrib1, y=attrib2, height=800,
                         color=color, color_continuous_scale=colormap, labels={attrib1: attrib1.replace("_", " ").title(),
@@ -274,25 +322,19 @@ def make_correlations_graphs(df, attrib1, attrib2, corr_color_seq, corr_color_di
             fig.add_trace(fig2.data[0])
             fig.update_coloraxes(showscale=False)
 
-        return  {
-            "children" : [
-                html.H5("Scatter Plot"),
-                html.H6("{}(x) vs {}(y)".format(attrib1.replace("_", " ").title(), attrib2.replace("_", " ").title())),
-                dcc.Graph(
-                    id={
-                        'type': "correlations-graph",
-                        'index': 0,
-                    }, 
-                    figure=fig
-                ),
-            ],
-            "dataframe" : df_to_use
-        }
-
-    return  {
-            "children" : [],
-            "dataframe" : []
-        }
+        return [
+            html.H5("Scatter Plot"),
+            html.H6("{}(x) vs {}(y)".format(attrib1.replace("_", " ").title(), attrib2.replace("_", " ").title())),
+            dcc.Graph(
+                id={
+                    'type': "correlations-graph",
+                    'index': 0,
+                }, 
+                figure=fig
+            ),
+        ]
+
+    return []
 
 # Convert the number of minutes that have passed in a day to HH:MM
 def min_to_time(mins):
@@ -307,39 +349,41 @@ def min_to_time(mins):
 
     return hours_string + ':' + mins_string
 
-# Helper function to set sorting order on graph
-def add_sort_order(fig, req_order):
+# The order of the categories on the x axis for a sorting order
+def sort_category_order(req_order):
     if req_order == SORT_ORDER_OPTIONS[1]:
-        fig.update_xaxes(categoryorder="total ascending")
+        return "total ascending"
     elif req_order == SORT_ORDER_OPTIONS[2]:
-        fig.update_xaxes(categoryorder="total descending")
+        return "total descending"
     elif req_order == SORT_ORDER_OPTIONS[0]:
-        fig.update_xaxes(categoryorder="category ascending")
+        return "category ascending"
+    return None
+
+# Helper function to set sorting order on graph
+def add_sort_order(fig, req_order):
+    category_order = sort_category_order(req_order)
+    if category_order is not None:
+        fig.update_xaxes(categoryorder=category_order)
     return fig
 
-# Helper function to add fatality rate attribute to df
-def calculate_fatality_rate(df_temp, attrib1):
-    # Compute the number of fatal accidents in each category
-    df_fatal = df_temp[['accident_severity', attrib1]][df_temp["accident_severity"] == 1].groupby(attrib1).count()[
-        ['accident_severity']]
+# Helper function to add fatality rate attribute to the accident counts of attrib1
+def calculate_fatality_rate(df_counts, attrib1):
+    df_fatal = df_counts.set_index(attrib1)[['fatal_count', 'accident_count']]
     # Rename column
-    df_fatal.rename(columns={"accident_severity": "fatal_accident_count"}, inplace=True)
-    # Compute total number of accidents in each category
-    df_fatal["accident_count"] = df_temp.groupby(attrib1).count()["accident_index"]
+    df_fatal = df_fatal.rename(columns={"fatal_count": "fatal_accident_count"})
     # Compute fatality rate of accidents in each category,
     # later used in color scale
     df_fatal["fatality_rate"] = round(df_fatal["fatal_accident_count"] / df_fatal["accident_count"] * 100, 2)
 
     return df_fatal
 
-@ app.callback(Output('correlations-kmeans-settings', 'style'),
+# Show the K-Means settings when both attributes are quantitative, in the browser (assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='kmeansSettings'),
+    Output('correlations-kmeans-settings', 'style'),
     Input({'type': 'correlations-attrib-x', 'index': ALL}, 'value'),
-    Input({'type': 'correlations-attrib-y', 'index': ALL}, 'value'))
-def show_hide_homepage(attrib_x, attrib_y):
-    if attrib_x[0] in QUANTITATIVE_ATTRIBS and attrib_y[0] in QUANTITATIVE_ATTRIBS:
-        return {'display': 'block'}
-    
-    return {'display': 'none'}
+    Input({'type': 'correlations-attrib-y', 'index': ALL}, 'value'),
+    State('clientside-config', 'data'))
 
 @app.callback(Output("indicator", "children"),
               Input('attrib2-slider', 'value'))
@@ -5,17 +5,52 @@ import pandas as pd
 from dash.dependencies import Input, Output, State
 
 from viz_app.main import app
+from viz_app.data import available_years
 
-from config import ID_TO_LOCAL_DISTRICT, ID_TO_REGION, POPULATION_BY_REGION, SEQ_CONT_COL
+from config import ID_TO_LOCAL_DISTRICT, ID_TO_REGION, POPULATION_BY_REGION, SEQ_CONT_COL, GEOJSON_DECIMALS
 
 from urllib.request import urlopen
 import json
 
 from viz_app.views.correlations import generate_dropdown_label
+
+
+# A ring of a polygon with its coordinates rounded to GEOJSON_DECIMALS. Points that are the same
+# after rounding are dropped, unless too few points would be left for a ring.
+def simplify_ring(ring):
+    rounded = [[round(point[0], GEOJSON_DECIMALS), round(point[1], GEOJSON_DECIMALS)] for point in ring]
+    points = [point for i, point in enumerate(rounded) if i == 0 or point != rounded[i - 1]]
+    return points if len(points) >= 4 else rounded
+
+# The maps are embedded in every map figure that is sent to the browser, so only the property the
+# features are matched on is kept and the coordinates are rounded
+def simplify_geojson(geojson, name):
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = [simplify_ring(ring) for ring in geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            coordinates = [[simplify_ring(ring) for ring in polygon] for polygon in geometry['coordinates']]
+        else:
+            coordinates = geometry['coordinates']
+        features.append({
+            'type': 'Feature',
+            'properties': {name: feature['properties'][name]},
+            'geometry': {'type': geometry['type'], 'coordinates': coordinates},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+# The features of a map with one of the given names
+def select_features(geojson, name, names):
+    names = set(names)
+    return {'type': 'FeatureCollection',
+            'features': [f for f in geojson['features'] if f['properties'][name] in names]}
+
 with urlopen('https://opendata.arcgis.com/datasets/2a1e3c23f1f24f15808275f52b8ae20d_0.geojson') as response:
-    policeRegions = json.load(response)
+    policeRegions = simplify_geojson(json.load(response), 'PFA20NM')
 with urlopen('https://opendata.arcgis.com/datasets/ac4ad96a586b4e4bab306dd59eb09401_0.geojson') as response:
-    localRegions = json.load(response)
+    localRegions = simplify_geojson(json.load(response), 'LAD21NM')
 
 
 # The settings for the map visualization.
@@ -40,6 +75,18 @@ def make_map_panel():
                         value='accident_count_per_capita'
                     )
                 ]),
+                # The map can show the accidents of every year from the dataset year through this year
+                html.Div([
+                    html.Label("Through Year"),
+                    dcc.Dropdown(
+                        id={
+                            'type': "through-year",
+                            'index': 0,
+                        },
+                        options=[{"label": i, "value": i} for i in available_years()],
+                        placeholder="Only the dataset year",
+                        searchable=False)
+                ]),
                 # A dropdown that allows the user to choose another sequential continuous color palette. 
                 # Sequential and Continuous color palettes only, because the fatality rate is 
                 # sequentially ordered. The color palettes are built-in from Plotly, see
@@ -73,12 +120,14 @@ def map_graph_options(n_clicks, filter_json):
 
     return [{'label': generate_dropdown_label(a), 'value': a} for a in ['accident_count_per_capita', 'accident_count', 'fatality_rate']], 'accident_count_per_capita'
 
-def make_map_graphs(df, regions, attrib, map_color_seq):
+# Make the map from the number of (fatal) accidents per region, or per region and local district
+# when we are filtering on specific regions
+def make_map_graphs(df_counts, regions, attrib, map_color_seq):
     if attrib == None:
         return
         
     # Filter out the accidents in Scotland since we don't have a map which supports this.
-    processed_df = df[df['region'] < 90][['region', 'accident_severity', 'local_district']].copy()
+    processed_df = df_counts[df_counts['region'] < 90].copy()
 
     region_map = policeRegions
     region_key = 'properties.PFA20NM'
@@ -88,22 +137,19 @@ def make_map_graphs(df, regions, attrib, map_color_seq):
     if regions:
         processed_df = processed_df[processed_df['region'].isin(regions)]
         processed_df['local_district'] = [ID_TO_LOCAL_DISTRICT[x] for x in processed_df['local_district']]
-        region_map = localRegions
+        # Only the districts of the chosen regions are sent
+        region_map = select_features(localRegions, 'LAD21NM', processed_df['local_district'])
         region_key = 'properties.LAD21NM'
         region_attrib = 'local_district'
 
     processed_df['region'] = [ID_TO_REGION[x] for x in processed_df['region']]
+    processed_df = processed_df.groupby([region_attrib])[['accident_count', 'fatal_count']].sum().reset_index()
 
     # Process the data according to the attrib.
     if attrib == 'fatality_rate':
-        processed_df = (processed_df[processed_df['accident_severity']==1].groupby([region_attrib]).size() * 100 \
-                        / processed_df.groupby([region_attrib]).size()).reset_index(name='fatality_rate')    
-    elif attrib == 'accident_count':
-        processed_df = processed_df.groupby([region_attrib]).size().reset_index(name='accident_count')
+        processed_df['fatality_rate'] = processed_df['fatal_count'] * 100 / processed_df['accident_count']
     elif attrib == 'accident_count_per_capita':
-        processed_df = processed_df.groupby([region_attrib]).size().reset_index(name='accident_count')
-        processed_df[attrib] = [processed_df[processed_df[region_attrib] == x]['accident_count'].values[0] / 
-                                                POPULATION_BY_REGION[x] for x in processed_df[region_attrib]]
+        processed_df[attrib] = processed_df['accident_count'] / processed_df[region_attrib].map(POPULATION_BY_REGION)
         
     fig = px.choropleth(processed_df, geojson=region_map, featureidkey=region_key,
                         locations=region_attrib, color=attrib,
@@ -118,5 +164,5 @@ def make_map_graphs(df, regions, attrib, map_color_seq):
     fig.update_geos(fitbounds="locations", visible=False)
     return [
         html.H5("Map Graph"),
-        dcc.Graph(figure=fig),
+        dcc.Graph(id={'type': "map-graph", 'index': 0}, figure=fig),
     ]
\ No newline at end of file
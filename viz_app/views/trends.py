@@ -3,46 +3,29 @@ import calendar
 from dash import html
 from dash import dcc
 import plotly.express as px
+import numpy as np
 import pandas as pd
 
 from config import CATEGORICAL_ATTRIBS, QUANTITATIVE_ATTRIBS, DISCRETE_COL
+from viz_app.data import DAY_LABELS, available_years
 from viz_app.views.correlations import generate_dropdown_label
 
-def make_trends_graphs(df, other_df, attrib, trends_color_disc):
+# Make the trend graph from the number of (fatal) accidents per day of the year (day_of_year)
+# of every year (accident_year)
+def make_trends_graphs(df_counts, attrib, trends_color_disc):
     if attrib == None:
         return
 
-    # Take the relevant columns of both dataframes.
-    df_year1 = df[['date', 'accident_year', 'accident_severity']]
-    df_year2 = other_df[['date', 'accident_year', 'accident_severity']]
-
-    # Join the two years together.
-    processed_df = pd.concat([df_year1, df_year2], axis=0)
-
-    # Convert the date to MM:DD instead of DD:MM, this way the ordering is easier.
-    processed_df['date'] = processed_df['date'].str[3:6] + processed_df['date'].str[0:2]
+    processed_df = df_counts.copy()
     if attrib == 'fatality_rate':
-        processed_df = (processed_df[processed_df['accident_severity']==1].groupby(['date', 'accident_year']).size() \
-                        / processed_df.groupby(['date', 'accident_year']).size()).reset_index(name='fatality_rate')    
-    else:
-        processed_df = processed_df.groupby(['date', 'accident_year']).size().reset_index(name='accident_count')
-    
-    # Add empty rows to align data.
-    years = processed_df['accident_year'].unique()
-    for index, row in processed_df.iterrows():
-        other_year = years[0]
-        if row['accident_year'] == years[0]:
-            other_year = years[1]
-        
-        # If there is no accident on this day for the other year, add an empty row.
-        if row['date'] not in processed_df[processed_df['accident_year'] == other_year]['date'].unique():
-            processed_df = processed_df.append({
-                'accident_year': other_year, 
-                'date': row['date'],
-            }, 
-            ignore_index=True)
+        processed_df['fatality_rate'] = processed_df['fatal_count'] / processed_df['accident_count']
+
+    # Add empty rows to align data, every year gets a row for each day that has accidents in any year.
+    processed_df = processed_df.set_index(['day_of_year', 'accident_year'])[attrib].unstack() \
+                               .stack(dropna=False).reset_index(name=attrib)
 
-    # Make sure it is still sorted after adding the empty rows.
+    # Label the days as MM/DD, the day of the year has the same ordering.
+    processed_df['date'] = np.take(DAY_LABELS, processed_df['day_of_year'] - 1)
     processed_df.sort_values('date', inplace=True)
 
     fig = px.line(processed_df, x='date', y=attrib, color='accident_year', markers=True,
@@ -51,11 +34,12 @@ def make_trends_graphs(df, other_df, attrib, trends_color_disc):
                   color_discrete_sequence=trends_color_disc)
     return [
         html.H5("Trend Graph"),
-        dcc.Graph(figure=fig),
+        dcc.Graph(id={'type': "trends-graph", 'index': 0}, figure=fig),
     ]
 
 # The settings for the trends visualization.
 def make_trends_panel():
+    years = available_years()
     return [
         html.Div(
             style={
@@ -68,11 +52,24 @@ def make_trends_panel():
                     html.Label("Other Year"),
                     dcc.Dropdown(
                         id={
-                            'type': "trends-attrib",
+                            'type': "trends-year",
+                            'index': 0,
+                        },
+                        options=[{"label": i, "value": i} for i in years],
+                        # The year before the latest year
+                        value=years[-2] if len(years) > 1 else None,
+                        searchable=False)
+                ]),
+                # Every year from the dataset year through this year gets a line, next to the other year
+                html.Div([
+                    html.Label("Through Year"),
+                    dcc.Dropdown(
+                        id={
+                            'type': "through-year",
                             'index': 0,
                         },
-                        options=[{"label": i, "value": i} for i in range(1979, 2021)],
-                        value=2019,
+                        options=[{"label": i, "value": i} for i in years],
+                        placeholder="Only the dataset year",
                         searchable=False)
                 ]),
                 html.Div([
@@ -80,7 +77,7 @@ def make_trends_panel():
                     dcc.Dropdown(
                         id={
                             'type': "trends-attrib",
-                            'index': 1,
+                            'index': 0,
                         },
                         options=[{'label': generate_dropdown_label(a), 'value': a} for a in ['fatality_rate', 'accident_count']],
                         value='accident_count',
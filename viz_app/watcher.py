@@ -0,0 +1,56 @@
+import os
+import threading
+import time
+import traceback
+
+from viz_app.data import build_lock, available_years, csv_path, store_is_fresh, build_store
+from config import WATCH_INTERVAL_SECONDS
+
+
+# Watches the dataset directory for added or changed road_safety_<year>.csv files and rebuilds the
+# store of those years in a background thread (or process, see gunicorn.conf.py). The old store is
+# used until the new one replaces it. Every server process then drops its cached data of the old
+# store itself, when it reads the year again (see source_signature in viz_app/data.py).
+class DatasetWatcher:
+
+    def __init__(self, interval=WATCH_INTERVAL_SECONDS):
+        self.interval = interval
+        # Signature of the csv files that changed during the last scan, a file is only
+        # rebuilt when it did not change between two scans (it may still be copied)
+        self.pending = {}
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="dataset-watcher", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception:
+                # Keep watching, the year is tried again at the next scan
+                traceback.print_exc()
+
+    # Rebuild the years with a csv file that is newer than their store
+    def scan(self):
+        changed = {}
+        for year in available_years():
+            path = csv_path(year)
+            if os.path.exists(path) and not store_is_fresh(year):
+                stat = os.stat(path)
+                changed[year] = (stat.st_mtime_ns, stat.st_size)
+        for year, signature in changed.items():
+            if self.pending.get(year) == signature:
+                self.rebuild(year)
+        self.pending = changed
+
+    def rebuild(self, year):
+        with build_lock:
+            if not store_is_fresh(year):
+                build_store(year)
+
+
+watcher = DatasetWatcher()
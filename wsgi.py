@@ -0,0 +1,23 @@
+import gc
+
+from app import app
+from viz_app.data import preload_years, frame_cache
+from viz_app.query import split_aggregate_budget
+from viz_app.jobs import jobs
+from config import SERVER_WORKERS
+
+
+# Entry point of the production server, see gunicorn.conf.py. The data of every year is loaded
+# when this module is imported, with preload_app the server does that once before it forks the
+# workers. The workers share the memory of the data (copy-on-write) as long as nobody writes to
+# it: cached frames are read-only, the preloaded years are shared entries of the cache that are
+# never evicted, and the garbage collector leaves the objects made so far alone.
+preload_years()
+frame_cache.share()
+gc.freeze()
+
+# Every server process starts its own aggregate and job workers, they share the cores and the memory
+split_aggregate_budget(SERVER_WORKERS)
+jobs.split(SERVER_WORKERS)
+
+server = app.server